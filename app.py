@@ -13,23 +13,35 @@ import streamlit as st
 import graphviz
 import os
 import time
-import google.generativeai as genai
 import json
 import re
-import hashlib
-import pandas as pd
+from collections import defaultdict, deque
 from google.api_core import exceptions as google_exceptions
 
 # モジュール群のインポート
-from data import TOPOLOGY
+from data import (
+    TOPOLOGY,
+    REDUNDANCY_PARTNERS,
+    CHILDREN_BY_PARENT,
+    load_device_config,
+    device_config_mtime_ns,
+    find_node_id,
+    find_topology_node_id
+)
 from logic import CausalInferenceEngine, Alarm, simulate_cascade_failure
 from network_ops import (
     run_diagnostic_simulation,
     generate_remediation_commands,
     generate_analyst_report,
     generate_analyst_report_streaming,
+    generate_analyst_reports_batch,
     generate_remediation_commands_streaming,
     compute_cache_hash,
+    compute_prompt_hash,
+    compute_stable_key,
+    compute_text_hash,
+    normalize_verification_context,
+    get_generative_model,
     predict_initial_symptoms,
     generate_fake_log_by_ai,
     run_remediation_parallel_v2,
@@ -38,11 +50,26 @@ from network_ops import (
 )
 from verifier import verify_log_content, format_verification_report
 from inference_engine import LogicalRCA
-from rate_limiter import GlobalRateLimiter, RateLimitConfig
+from rate_limiter import GlobalRateLimiter, RateLimitConfig, LRUCache, compute_backoff_delay, dumps_sorted
 
 # --- ページ設定 ---
 st.set_page_config(page_title="Antigravity Autonomous", page_icon="⚡", layout="wide")
 
+# --- トポロジー描画設定 ---
+TOPOLOGY_LAYOUT_ENGINE = "dot"          # 通常時のレイアウトエンジン
+TOPOLOGY_LARGE_LAYOUT_ENGINE = "neato"  # 大規模トポロジー用（事前計算した座標をそのまま使い、レイアウト計算を省く）
+TOPOLOGY_LARGE_NODE_THRESHOLD = 200     # この台数を超えたら大規模用エンジンに切り替え
+TOPOLOGY_NODE_SPACING = (180, 100)      # 大規模時の座標間隔 (横, 縦) [pt]
+
+# --- チャット設定 ---
+CHAT_HISTORY_MAX_MESSAGES = 200         # 保持する会話履歴の上限（超過分は古い順に破棄）
+
+# --- レポートキャッシュ設定 ---
+REPORT_CACHE_MAX_ENTRIES = 64           # セッション内に保持する生成済みレポート・修復プランの上限
+
+# --- 診断ログ表示設定 ---
+DIAG_LOG_DISPLAY_MAX_CHARS = 3000       # 画面に表示するサニタイズ済みログの最大文字数
+
 # =====================================================
 # レートリミッター初期化
 # =====================================================
@@ -57,68 +84,112 @@ def get_rate_limiter():
 
 rate_limiter = get_rate_limiter()
 
+# =====================================================
+# 推論エンジン初期化
+# =====================================================
+@st.cache_resource
+def get_logic_engine():
+    """LogicalRCA のシングルトンインスタンスを取得（TOPOLOGY は起動時に固定）"""
+    return LogicalRCA(TOPOLOGY)
+
+
+@st.cache_data(ttl=600, max_entries=128, show_spinner=False)
+def infer_root_cause_cached(msg_key: tuple):
+    """同一アラーム構成に対する推論結果を再利用
+
+    msg_key は _alarm_message_key() の戻り値（((device_id, (message, ...)), ...) 形式）。
+    """
+    return get_logic_engine().infer_root_cause({dev_id: list(msgs) for dev_id, msgs in msg_key})
+
+# =====================================================
+# チャット用モデル初期化
+# =====================================================
+CHAT_MODEL_NAME = "gemma-3-12b-it"
+
+def get_chat_model(api_key: str, model_name: str = CHAT_MODEL_NAME, temperature: float = None):
+    """チャット用 GenerativeModel を取得（生成は network_ops の共通ファクトリでプロセス内キャッシュ）"""
+    return get_generative_model(api_key, model_name, temperature)
+
 # =====================================================
 # ユーティリティ関数
 # =====================================================
 def find_target_node_id(topology, node_type=None, layer=None, keyword=None):
-    """トポロジーから条件に合うノードIDを検索"""
-    for node_id, node in topology.items():
-        if node_type and node.type != node_type:
-            continue
-        if layer and node.layer != layer:
-            continue
-        if keyword:
-            hit = False
-            if keyword in node_id:
-                hit = True
-            for v in node.metadata.values():
-                if isinstance(v, str) and keyword in v:
-                    hit = True
-            if not hit:
-                continue
-        return node_id
-    return None
+    """トポロジーから条件に合うノードIDを検索（モジュールの TOPOLOGY はメモ化済みの検索を使う）"""
+    if topology is TOPOLOGY:
+        return find_topology_node_id(node_type, layer, keyword)
+    return find_node_id(topology, node_type, layer, keyword)
 
 
 def load_config_by_id(device_id):
-    """configsフォルダから設定ファイルを読み込む"""
-    possible_paths = [f"configs/{device_id}.txt", f"{device_id}.txt"]
-    for path in possible_paths:
-        if os.path.exists(path):
-            try:
-                with open(path, "r", encoding="utf-8") as f:
-                    return f.read()
-            except Exception:
-                pass
-    return "Config file not found."
+    """configsフォルダから設定ファイルを読み込む（mtime検証付きキャッシュ経由）"""
+    content = load_device_config(device_id)
+    if content is None:
+        return "Config file not found."
+    return content
+
+
+def _new_chat_history() -> deque:
+    """上限付きの会話履歴を生成（append 時に最古のメッセージが自動で押し出される）"""
+    return deque(maxlen=CHAT_HISTORY_MAX_MESSAGES)
+
+
+def _reset_for_scenario_change(new_scenario: str):
+    """シナリオ切り替え時にシナリオ依存のセッション状態を初期化"""
+    st.session_state.current_scenario = new_scenario
+    st.session_state.recovered_devices = {}
+    st.session_state.recovered_scenario_map = {}
+    st.session_state.messages = _new_chat_history()
+    st.session_state.pop("last_chat_prompt_token", None)
+    st.session_state.chat_session = None
+    st.session_state.live_result = None
+    st.session_state.trigger_analysis = False
+    st.session_state.verification_result = None
+    st.session_state.generated_report = None
+    st.session_state.verification_log = None
+    st.session_state.last_report_cand_id = None
+    st.session_state.balloons_shown = False
+    st.session_state.pop("remediation_plan", None)
+
+
+def _generate_content_limited(model, prompt, stream):
+    """同時実行数の枠内で generate_content を呼ぶ（stream=True では応答を読み切るまで枠を保持）"""
+    if stream:
+        return rate_limiter.stream_in_slot(lambda: model.generate_content(prompt, stream=True))
+    with rate_limiter.concurrency_slot():
+        return model.generate_content(prompt)
+
+
+# リトライ対象の一時的なエラー（過負荷・レート超過）
+_RETRYABLE_API_ERRORS = (google_exceptions.ServiceUnavailable, google_exceptions.ResourceExhausted)
+
+
+def _retry_backoff(attempt: int):
+    """リトライ前の待機（ジッター付き指数バックオフ。リトライ箇所で共通に使う）"""
+    time.sleep(compute_backoff_delay(attempt, base_delay=2.0, max_delay=30.0))
+
+
+def _generate_content_once(model, prompt, stream):
+    """レート制限枠を確保して generate_content を1回だけ呼ぶ（リトライは呼び出し側で行う）"""
+    if not rate_limiter.acquire(timeout=60):
+        raise RuntimeError("Rate limit timeout")
+    return _generate_content_limited(model, prompt, stream)
 
 
 def generate_content_with_retry(model, prompt, stream=True, retries=3):
-    """503エラー対策のリトライ付き生成関数（レートリミッター統合）"""
+    """503/429エラー対策のリトライ付き生成関数（ジッター付きバックオフ）"""
     for i in range(retries):
         try:
-            # レート制限待機
-            if not rate_limiter.wait_for_slot(timeout=60):
-                raise RuntimeError("Rate limit timeout")
-            rate_limiter.record_request()
-            return model.generate_content(prompt, stream=stream)
-        except google_exceptions.ServiceUnavailable:
+            return _generate_content_once(model, prompt, stream)
+        except _RETRYABLE_API_ERRORS:
             if i == retries - 1:
                 raise
-            time.sleep(2 * (i + 1))
-        except Exception as e:
-            if '429' in str(e) or 'rate' in str(e).lower():
-                if i == retries - 1:
-                    raise
-                time.sleep(5 * (i + 1))
-            else:
-                raise
+            _retry_backoff(i)
     return None
 
 
 def _hash_text(text: str) -> str:
-    """テキストのハッシュ値を計算"""
-    return hashlib.sha256((text or "").encode("utf-8")).hexdigest()[:16]
+    """テキストのハッシュ値を計算（キャッシュキー用。network_ops と同じ blake2b ハッシュを使う）"""
+    return compute_text_hash(text or "")
 
 
 def _pick_first(mapping: dict, keys: list, default: str = "") -> str:
@@ -148,7 +219,30 @@ def _pick_first(mapping: dict, keys: list, default: str = "") -> str:
 
 
 def _build_ci_context_for_chat(target_node_id: str) -> dict:
-    """チャット用のCIコンテキストを構築"""
+    """チャット用のCIコンテキストを取得（コンフィグの更新時刻をキーにキャッシュ）"""
+    config_mtime_ns = device_config_mtime_ns(target_node_id) if target_node_id else 0
+    return _ci_context_for_chat_cached(target_node_id, config_mtime_ns)
+
+
+def _ci_prompt_block(target_node_id: str) -> str:
+    """チャットプロンプトに埋め込む CI の JSON 文字列を取得（CI と同じキーでキャッシュ）"""
+    if not target_node_id:
+        return "{}"
+    return _ci_prompt_block_cached(target_node_id, device_config_mtime_ns(target_node_id))
+
+
+@st.cache_data(max_entries=128, show_spinner=False)
+def _ci_prompt_block_cached(target_node_id: str, config_mtime_ns: int) -> str:
+    """CI を JSON にシリアライズ（config_mtime_ns はキャッシュ無効化用のキー）
+
+    プロンプトに埋め込むため、インデント・区切りの空白を省いた compact 形式にする。
+    """
+    return json.dumps(_ci_context_for_chat_cached(target_node_id, config_mtime_ns), ensure_ascii=False, separators=(",", ":"))
+
+
+@st.cache_data(max_entries=128, show_spinner=False)
+def _ci_context_for_chat_cached(target_node_id: str, config_mtime_ns: int) -> dict:
+    """チャット用のCIコンテキストを構築（config_mtime_ns はキャッシュ無効化用のキー）"""
     node = TOPOLOGY.get(target_node_id) if target_node_id else None
     md = (getattr(node, "metadata", None) or {}) if node else {}
 
@@ -177,13 +271,18 @@ def _build_ci_context_for_chat(target_node_id: str) -> dict:
 
 def _safe_chunk_text(chunk) -> str:
     """google.generativeai の stream chunk から安全にテキストを取り出す"""
+    # 通常の chunk は .text で取れるため、候補の走査は取得できない場合のみ行う
     try:
-        t = getattr(chunk, "text", "")
+        t = chunk.text
         if t:
             return t
     except Exception:
         pass
+    return _chunk_parts_text(chunk)
+
 
+def _chunk_parts_text(chunk) -> str:
+    """chunk.candidates[0].content.parts からテキストを連結（.text が使えない chunk 用）"""
     try:
         cands = getattr(chunk, "candidates", None) or []
         if not cands:
@@ -200,6 +299,39 @@ def _safe_chunk_text(chunk) -> str:
         return ""
 
 
+def _stream_response_text(response):
+    """stream=True の応答からテキスト片を順に取り出す（st.write_stream 用）"""
+    for chunk in response:
+        text = _safe_chunk_text(chunk)
+        if text:
+            yield text
+
+
+def stream_text_with_retry(model, prompt, retries=3):
+    """ストリーミング応答のテキスト片を順に返す（リトライ付き）
+
+    stream=True では 429/503 が最初の chunk 取得時に送出されることがあるため、
+    接続時のエラーと合わせてこのループだけで再試行する。まだ何も出力していない段階なら
+    接続からやり直し、出力開始後のエラーは表示済みの内容と整合しなくなるため、そのまま送出する。
+    """
+    for i in range(retries):
+        emitted = False
+        try:
+            # リトライはこのループだけで行う（1試行につき SDK 呼び出しは1回）
+            response = _generate_content_once(model, prompt, stream=True)
+            for text in _stream_response_text(response):
+                emitted = True
+                yield text
+            return
+        except _RETRYABLE_API_ERRORS:
+            if emitted or i == retries - 1:
+                raise
+            _retry_backoff(i)
+
+
+_FENCED_CODEBLOCK_RE = re.compile(r"```[a-zA-Z0-9_+-]*\s*\n(.*?)\n```", re.DOTALL)
+
+
 def _extract_first_codeblock_after_heading(markdown_text: str, heading_keyword: str) -> str:
     """Extract the first fenced code block after a heading containing heading_keyword"""
     if not markdown_text or not heading_keyword:
@@ -207,122 +339,205 @@ def _extract_first_codeblock_after_heading(markdown_text: str, heading_keyword:
     idx = markdown_text.find(heading_keyword)
     if idx < 0:
         return ""
-    tail = markdown_text[idx:]
-    m = re.search(r"```[a-zA-Z0-9_+-]*\s*\n(.*?)\n```", tail, flags=re.DOTALL)
+    m = _FENCED_CODEBLOCK_RE.search(markdown_text, idx)
     if not m:
         return ""
     return (m.group(1) or "").strip()
 
 
+# 疑似診断（LLMなし）で出力するコマンド結果のテンプレート（機器種別 → 改行連結済みの本文）
+# 種別 "" は該当なし時の既定
+_DIAG_RECOVERED_BODIES = {
+    "FW": "\n".join((
+        "show chassis cluster status",
+        "Redundancy group 0: healthy",
+        "control link: up",
+        "fabric link: up",
+    )),
+    "WAN": "\n".join((
+        "show ip interface brief",
+        "GigabitEthernet0/0 up up",
+        "show ip bgp summary",
+        "Neighbor 203.0.113.2 Established",
+        "ping 203.0.113.2 repeat 5",
+        "Success rate is 100 percent (5/5)",
+    )),
+    "L2SW": "\n".join((
+        "show environment",
+        "Fan: OK",
+        "Temperature: OK",
+        "show interface status",
+        "Uplink: up",
+    )),
+    "": "\n".join((
+        "show system alarms",
+        "No active alarms",
+        "ping 8.8.8.8 repeat 5",
+        "Success rate is 100 percent (5/5)",
+    )),
+}
+
+_DIAG_FAILURE_BODIES = {
+    "WAN": "\n".join((
+        "show ip interface brief",
+        "GigabitEthernet0/0 down down",
+        "show ip bgp summary",
+        "Neighbor 203.0.113.2 Idle",
+        "ping 203.0.113.2 repeat 5",
+        "Success rate is 0 percent (0/5)",
+    )),
+    "FW": "\n".join((
+        "show chassis cluster status",
+        "Redundancy group 0: degraded",
+        "control link: down",
+        "fabric link: up",
+    )),
+    "L2SW": "\n".join((
+        "show environment",
+        "Fan: FAIL",
+        "Temperature: HIGH",
+        "show interface status",
+        "Uplink: flapping",
+    )),
+    "": "\n".join((
+        "show system alarms",
+        "No active alarms",
+    )),
+}
+
+
+def _diag_probe_kinds(scenario: str) -> tuple:
+    """シナリオ名から疑似診断テンプレートの種別 (障害時, 復旧後) を判定"""
+    if "WAN全回線断" in scenario or "[WAN]" in scenario:
+        failure_kind = "WAN"
+    elif "FW片系障害" in scenario or "[FW]" in scenario:
+        failure_kind = "FW"
+    elif "L2SW" in scenario:
+        failure_kind = "L2SW"
+    else:
+        failure_kind = ""
+
+    if "FW" in scenario:
+        recovered_kind = "FW"
+    elif "WAN" in scenario:
+        recovered_kind = "WAN"
+    elif "L2SW" in scenario:
+        recovered_kind = "L2SW"
+    else:
+        recovered_kind = ""
+    return failure_kind, recovered_kind
+
+
 def run_diagnostic_simulation_no_llm(selected_scenario, target_node_obj):
     """LLMを呼ばない疑似診断（503/コスト対策）"""
     device_id = getattr(target_node_obj, "id", "UNKNOWN") if target_node_obj else "UNKNOWN"
     ts = time.strftime("%Y-%m-%d %H:%M:%S")
-    lines = [
-        f"[PROBE] ts={ts}",
-        f"[PROBE] scenario={selected_scenario}",
-        f"[PROBE] target_device={device_id}",
-        "",
-    ]
 
-    recovered_devices = st.session_state.get("recovered_devices") or {}
-    recovered_map = st.session_state.get("recovered_scenario_map") or {}
+    # 既知のシナリオは事前に判定済みの種別を引く
+    failure_kind, recovered_kind = DIAG_PROBE_KINDS.get(selected_scenario) or _diag_probe_kinds(selected_scenario)
+
+    # セッション初期化で空 dict が入っているため、そのまま参照する
+    recovered_devices = st.session_state.recovered_devices
+    recovered_map = st.session_state.recovered_scenario_map
 
     if recovered_devices.get(device_id) and recovered_map.get(device_id) == selected_scenario:
-        if "FW" in selected_scenario:
-            lines += [
-                "show chassis cluster status",
-                "Redundancy group 0: healthy",
-                "control link: up",
-                "fabric link: up",
-            ]
-        elif "WAN" in selected_scenario or "WAN全回線断" in selected_scenario:
-            lines += [
-                "show ip interface brief",
-                "GigabitEthernet0/0 up up",
-                "show ip bgp summary",
-                "Neighbor 203.0.113.2 Established",
-                "ping 203.0.113.2 repeat 5",
-                "Success rate is 100 percent (5/5)",
-            ]
-        elif "L2SW" in selected_scenario:
-            lines += [
-                "show environment",
-                "Fan: OK",
-                "Temperature: OK",
-                "show interface status",
-                "Uplink: up",
-            ]
-        else:
-            lines += [
-                "show system alarms",
-                "No active alarms",
-                "ping 8.8.8.8 repeat 5",
-                "Success rate is 100 percent (5/5)",
-            ]
-
-        return {
-            "status": "SUCCESS",
-            "sanitized_log": "\n".join(lines),
-            "verification_log": "N/A",
-            "device_id": device_id,
-        }
-
-    if "WAN全回線断" in selected_scenario or "[WAN]" in selected_scenario:
-        lines += [
-            "show ip interface brief",
-            "GigabitEthernet0/0 down down",
-            "show ip bgp summary",
-            "Neighbor 203.0.113.2 Idle",
-            "ping 203.0.113.2 repeat 5",
-            "Success rate is 0 percent (0/5)",
-        ]
-    elif "FW片系障害" in selected_scenario or "[FW]" in selected_scenario:
-        lines += [
-            "show chassis cluster status",
-            "Redundancy group 0: degraded",
-            "control link: down",
-            "fabric link: up",
-        ]
-    elif "L2SW" in selected_scenario:
-        lines += [
-            "show environment",
-            "Fan: FAIL",
-            "Temperature: HIGH",
-            "show interface status",
-            "Uplink: flapping",
-        ]
+        body = _DIAG_RECOVERED_BODIES[recovered_kind]
     else:
-        lines += [
-            "show system alarms",
-            "No active alarms",
-        ]
+        body = _DIAG_FAILURE_BODIES[failure_kind]
 
     return {
         "status": "SUCCESS",
-        "sanitized_log": "\n".join(lines),
+        "sanitized_log": f"[PROBE] ts={ts}\n[PROBE] scenario={selected_scenario}\n[PROBE] target_device={device_id}\n\n{body}",
         "verification_log": "N/A",
         "device_id": device_id,
     }
 
 
-def render_topology(alarms, root_cause_candidates):
-    """トポロジー図の描画"""
-    graph = graphviz.Digraph()
-    graph.attr(rankdir='TB')
-    graph.attr('node', shape='box', style='rounded,filled', fontname='Helvetica')
+def _on_diag_success(res, status):
+    """診断成功: ログ検証結果を保存し、解析トリガーを立てる"""
+    st.write("✅ Log Acquired & Sanitized.")
+    status.update(label="Diagnostics Complete!", state="complete", expanded=False)
+    st.session_state.verification_result = verify_log_content(res.get('sanitized_log', ""))
+    st.session_state.trigger_analysis = True
+
+
+def _on_diag_skipped(res, status):
+    """診断対象外のシナリオ"""
+    status.update(label="No Action Required", state="complete")
+
+
+def _on_diag_failed(res, status):
+    """接続失敗・エラー"""
+    st.write("❌ Connection Failed.")
+    status.update(label="Diagnostics Failed", state="error")
+
+
+# 診断結果のステータスごとの処理（未知のステータスは失敗として扱う）
+DIAG_STATUS_HANDLERS = {
+    "SUCCESS": _on_diag_success,
+    "SKIPPED": _on_diag_skipped,
+}
+
+
+# トポロジー構成の識別キー（描画用キャッシュのキーに使う）
+TOPOLOGY_KEY = tuple(TOPOLOGY)
 
-    alarm_map = {a.device_id: a for a in alarms}
-    alarmed_ids = set(alarm_map.keys())
-    root_cause_ids = {c['id'] for c in root_cause_candidates if c['prob'] > 0.6}
-    node_status_map = {c['id']: c['type'] for c in root_cause_candidates}
+# ノード状態ごとの描画スタイル: (塗り色, 枠線幅, 文字色, ラベル追記)
+TOPOLOGY_NODE_STYLES = {
+    "normal": ("#e8f5e9", "1", "black", ""),
+    "alarmed": ("#fff9c4", "1", "black", ""),
+    "root": ("#ffcdd2", "3", "black", "\n[ROOT CAUSE]"),
+    "unreachable": ("#cfd8dc", "1", "#546e7a", "\n[Unreachable]"),
+}
 
+
+def _is_large_topology() -> bool:
+    """事前計算座標で描画する規模のトポロジーか"""
+    return len(TOPOLOGY) > TOPOLOGY_LARGE_NODE_THRESHOLD
+
+
+@st.cache_resource
+def _topology_positions(topology_key: tuple) -> dict:
+    """階層レイアウトの座標を一度だけ計算 ({node_id: "x,y"}、単位は pt)
+
+    y はレイヤー順、x は同一レイヤー内で親の x 座標→定義順に並べて中央揃えにする。
+    """
+    x_gap, y_gap = TOPOLOGY_NODE_SPACING
+    by_layer = defaultdict(list)
     for node_id, node in TOPOLOGY.items():
-        color = "#e8f5e9"
-        penwidth = "1"
-        fontcolor = "black"
-        label = f"{node_id}\n({node.type})"
+        by_layer[node.layer].append(node_id)
+
+    xs = {}
+    positions = {}
+    for row, layer in enumerate(sorted(by_layer)):
+        members = sorted(by_layer[layer], key=lambda nid: xs.get(TOPOLOGY[nid].parent_id, 0.0))
+        offset = (len(members) - 1) / 2
+        for col, node_id in enumerate(members):
+            xs[node_id] = (col - offset) * x_gap
+            positions[node_id] = f"{xs[node_id]:.0f},{-row * y_gap}"
+    return positions
+
 
+@st.cache_resource
+def _topology_dot_parts(topology_key: tuple):
+    """TOPOLOGY から状態に依存しないDOT断片を事前生成
+
+    topology_key はノードIDのタプル（ノード構成が変わればキャッシュも作り直す）。
+
+    Returns:
+        (ヘッダ行, {node_id: {状態: ノード行}}, [(始点ID, 終点ID, エッジ行), ...]) のタプル
+    """
+    skeleton = graphviz.Digraph()
+    skeleton.attr(rankdir='TB')
+    skeleton.attr('node', shape='box', style='rounded,filled', fontname='Helvetica')
+    header = list(skeleton.body)
+    # 大規模時は座標を埋め込み、レイアウト計算なしで配置できるようにする
+    positions = _topology_positions(topology_key) if _is_large_topology() else {}
+
+    node_lines = {}
+    edge_lines = []
+    for node_id, node in TOPOLOGY.items():
+        label = f"{node_id}\n({node.type})"
         red_type = node.metadata.get("redundancy_type")
         if red_type:
             label += f"\n[{red_type} Redundancy]"
@@ -330,31 +545,583 @@ def render_topology(alarms, root_cause_candidates):
         if vendor:
             label += f"\n[{vendor}]"
 
-        status_type = node_status_map.get(node_id, "Normal")
+        pos_attr = {"pos": positions[node_id]} if node_id in positions else {}
+        variants = {}
+        for state, (color, penwidth, fontcolor, suffix) in TOPOLOGY_NODE_STYLES.items():
+            skeleton.node(node_id, label=label + suffix, fillcolor=color, color='black', penwidth=penwidth, fontcolor=fontcolor, **pos_attr)
+            variants[state] = skeleton.body.pop()
+        node_lines[node_id] = variants
+
+        # エッジ行も端点付きで取り出し、表示対象の絞り込みに使えるようにする
+        if node.parent_id:
+            for source_id in (node.parent_id, *REDUNDANCY_PARTNERS.get(node.parent_id, ())):
+                skeleton.edge(source_id, node_id)
+                edge_lines.append((source_id, node_id, skeleton.body.pop()))
+
+    return header, node_lines, edge_lines
+
+
+def _topology_node_state(node_id: str, status_type: str, alarmed_ids: set) -> str:
+    """推論結果とアラーム有無からノードの描画状態を決定"""
+    if "Hardware/Physical" in status_type or "Critical" in status_type or "Silent" in status_type:
+        return "root"
+    if "Network/Unreachable" in status_type or "Network/Secondary" in status_type:
+        return "unreachable"
+    if node_id in alarmed_ids:
+        return "alarmed"
+    return "normal"
+
+
+def _incident_node_ids(alarm_key: tuple, status_key: tuple) -> set:
+    """インシデント表示の対象ノード（異常ノードと、その上位ノード・冗長相方）
+
+    異常ノードが無ければ空集合を返す（呼び出し側で全体表示にする）。
+    """
+    stack = list(alarm_key)
+    stack.extend(node_id for node_id, status_type in status_key
+                 if _topology_node_state(node_id, status_type, ()) != "normal")
+    visible = set()
+    while stack:
+        node_id = stack.pop()
+        if node_id in visible or node_id not in TOPOLOGY:
+            continue
+        visible.add(node_id)
+        stack.extend(REDUNDANCY_PARTNERS.get(node_id, ()))
+        if TOPOLOGY[node_id].parent_id:
+            stack.append(TOPOLOGY[node_id].parent_id)
+    return visible
+
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def _build_topology_dot(alarm_key: tuple, status_key: tuple, full_view: bool = True) -> str:
+    """トポロジー図のDOTソースを構築（事前生成した行を状態に応じて選ぶだけ）
+
+    full_view=False ではインシデントに関係するノードとその間のエッジだけを描く。
+    """
+    header, node_lines, edge_lines = _topology_dot_parts(TOPOLOGY_KEY)
+    alarmed_ids = set(alarm_key)
+    node_status_map = dict(status_key)
+    visible = None if full_view else (_incident_node_ids(alarm_key, status_key) or None)
+
+    body = list(header)
+    for node_id, variants in node_lines.items():
+        if visible is not None and node_id not in visible:
+            continue
+        state = _topology_node_state(node_id, node_status_map.get(node_id, "Normal"), alarmed_ids)
+        body.append(variants[state])
+    body.extend(
+        line for source_id, target_id, line in edge_lines
+        if visible is None or (source_id in visible and target_id in visible)
+    )
+    return graphviz.Digraph(body=body).source
+
+
+def _topology_layout_engine() -> str:
+    """トポロジー規模に応じたレイアウトエンジンを選択"""
+    if _is_large_topology():
+        return TOPOLOGY_LARGE_LAYOUT_ENGINE
+    return TOPOLOGY_LAYOUT_ENGINE
+
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def _render_topology_svg(alarm_key: tuple, status_key: tuple, engine: str, full_view: bool = True):
+    """トポロジー図をサーバー側でSVGにレイアウト（同一状態ではレイアウトを再実行しない）"""
+    dot_source = _build_topology_dot(alarm_key, status_key, full_view)
+    try:
+        # 座標埋め込み済みの大規模図は neato -n で配置計算を省き、エッジの経路付けだけ行う
+        neato_no_op = 1 if engine == "neato" and _is_large_topology() else None
+        svg = graphviz.Source(dot_source, engine=engine).pipe(format="svg", neato_no_op=neato_no_op).decode("utf-8")
+    except (graphviz.ExecutableNotFound, graphviz.CalledProcessError):
+        # graphviz バイナリが無い環境ではブラウザ側の描画にフォールバック
+        return None
+    # XML宣言/DOCTYPE を除き、<svg> 要素から始まる文字列にする
+    return svg[svg.find("<svg"):]
+
+
+def _topology_status_key(root_cause_candidates) -> tuple:
+    """図に反映される候補ごとの障害種別をキャッシュキー化"""
+    return tuple((c['id'], c['type']) for c in root_cause_candidates)
+
+
+def render_topology(alarm_key: tuple, root_cause_candidates, full_view: bool = True):
+    """トポロジー図の描画（DOTソースを返す）
+
+    alarm_key はアラーム発生ノードIDのソート済みタプル（scenario_alarmed_ids() の戻り値）。
+    full_view=False ではインシデント関連ノードだけを描く（異常が無ければ全体）。
+    """
+    return _build_topology_dot(alarm_key, _topology_status_key(root_cause_candidates), full_view)
+
+
+def render_topology_svg(alarm_key: tuple, root_cause_candidates, full_view: bool = True):
+    """トポロジー図のSVGを返す（graphviz バイナリが無ければ None）"""
+    status_key = _topology_status_key(root_cause_candidates)
+    return _render_topology_svg(alarm_key, status_key, _topology_layout_engine(), full_view)
+
+
+def _incident_rows_key(analysis_results) -> tuple:
+    """インシデント一覧に表示される項目だけを取り出したキャッシュキー（行順は候補順）"""
+    return tuple(
+        (cand['id'], cand['type'], cand['prob'], cand['label'], bool(cand.get('verification_log')))
+        for cand in analysis_results
+    )
+
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def _build_incident_df(rows_key: tuple):
+    """インシデント一覧表示用の Arrow テーブルを構築（pyarrow は初回呼び出し時に読み込む）
+
+    rows_key は _incident_rows_key() の戻り値。行 i は analysis_results[i] に対応する。
+    列の型を固定して渡すため、st.dataframe 側で pandas の dtype 推論・変換が走らない。
+    """
+    import numpy as np
+    import pyarrow as pa
+
+    n = len(rows_key)
+    ids = [row[0] for row in rows_key]
+    types = [row[1] for row in rows_key]
+    # 閾値判定は元の精度 (float64) で行う（float32 だと 0.8 や 0.6 ちょうどの候補が上の区分に入る）
+    probs = np.fromiter((row[2] for row in rows_key), dtype=float, count=n)
+    unreachable = np.fromiter(
+        ("Network/Unreachable" in t or "Network/Secondary" in t for t in types), dtype=bool, count=n
+    )
+
+    # 上位障害による応答なしはスコアより優先
+    conditions = [unreachable, probs > 0.8, probs > 0.6]
+    statuses = np.select(conditions, ["⚫ 応答なし (上位障害)", "🔴 危険 (根本原因)", "🟡 警告 (被疑箇所)"], default="⚪ 監視中")
+    actions = np.select(conditions, ["⛔ 対応不要 (上位復旧待ち)", "🚀 自動修復が可能", "🔍 詳細調査を推奨"], default="👁️ 静観")
+
+    texts = [
+        f"デバイス: {dev_id} / 原因: {label}" + (" [🔍 Active Probe: 応答なし]" if probed else "")
+        for dev_id, _, _, label, probed in rows_key
+    ]
+
+    # 列ごとの配列から直接構築（pandas を経由しない）
+    return pa.table({
+        "順位": pa.array(np.arange(1, n + 1, dtype=np.int32), pa.int32()),
+        "ステータス": pa.array(statuses.tolist(), pa.string()),
+        "根本原因候補": pa.array(texts, pa.string()),
+        "リスクスコア": pa.array(probs, pa.float32()),
+        "推奨アクション": pa.array(actions.tolist(), pa.string()),
+        "ID": pa.array(ids, pa.string()),
+        "Type": pa.array(types, pa.string()),
+    })
 
-        if "Hardware/Physical" in status_type or "Critical" in status_type or "Silent" in status_type:
-            color = "#ffcdd2"
-            penwidth = "3"
-            label += "\n[ROOT CAUSE]"
-        elif "Network/Unreachable" in status_type or "Network/Secondary" in status_type:
-            color = "#cfd8dc"
-            fontcolor = "#546e7a"
-            label += "\n[Unreachable]"
-        elif node_id in alarmed_ids:
-            color = "#fff9c4"
 
-        graph.node(node_id, label=label, fillcolor=color, color='black', penwidth=penwidth, fontcolor=fontcolor)
+# =====================================================
+# シナリオ別アラーム生成
+# =====================================================
+# 各生成関数は (alarms, target_device_id, root_severity) を返す
+LIVE_SCENARIO_ID = 99
+
+SCENARIO_MAP = {
+    "基本・広域障害": ["正常稼働", "1. WAN全回線断", "2. FW片系障害", "3. L2SWサイレント障害"],
+    "WAN Router": ["4. [WAN] 電源障害：片系", "5. [WAN] 電源障害：両系", "6. [WAN] BGPルートフラッピング", "7. [WAN] FAN故障", "8. [WAN] メモリリーク"],
+    "Firewall (Juniper)": ["9. [FW] 電源障害：片系", "10. [FW] 電源障害：両系", "11. [FW] FAN故障", "12. [FW] メモリリーク"],
+    "L2 Switch": ["13. [L2SW] 電源障害：片系", "14. [L2SW] 電源障害：両系", "15. [L2SW] FAN故障", "16. [L2SW] メモリリーク"],
+    "複合・その他": ["17. [WAN] 複合障害：電源＆FAN", "18. [Complex] 同時多発：FW & AP", "99. [Live] Cisco実機診断"]
+}
+
+
+def _parse_scenario_label(scenario: str):
+    """シナリオ名の先頭番号（"4. [WAN] ..." → 4）を解析。番号が無ければ None"""
+    head, sep, _ = scenario.partition(".")
+    return int(head) if sep and head.isdigit() else None
+
+
+# シナリオ名 → シナリオ番号の逆引き（SCENARIO_MAP から一度だけ構築）
+SCENARIO_IDS = {
+    label: _parse_scenario_label(label)
+    for labels in SCENARIO_MAP.values()
+    for label in labels
+}
+
+
+# シナリオ名 → 疑似診断テンプレート種別（障害時, 復旧後）の表（同じく一度だけ構築）
+DIAG_PROBE_KINDS = {
+    label: _diag_probe_kinds(label)
+    for labels in SCENARIO_MAP.values()
+    for label in labels
+}
+
+
+def parse_scenario_id(scenario: str):
+    """シナリオ名からシナリオ番号を取得（既知のシナリオは逆引き表で引く）"""
+    if scenario in SCENARIO_IDS:
+        return SCENARIO_IDS[scenario]
+    return _parse_scenario_label(scenario)
+
+
+def _find_router():
+    return find_target_node_id(TOPOLOGY, node_type="ROUTER")
+
+
+def _find_firewall():
+    return find_target_node_id(TOPOLOGY, node_type="FIREWALL")
+
+
+def _find_l2_switch():
+    return find_target_node_id(TOPOLOGY, node_type="SWITCH", layer=4)
+
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def _simulate_cascade_cached(root_cause_id: str, custom_message: str = "Interface Down"):
+    """カスケード障害シミュレーションのキャッシュ版（TOPOLOGY は起動時に固定のため ID と文言で一意）"""
+    return simulate_cascade_failure(root_cause_id, TOPOLOGY, custom_message)
+
+
+def _single_alarm_scenario(find_target, message: str, severity: str):
+    """対象機器に単一アラームを出すシナリオの生成関数を作る"""
+    def build():
+        target = find_target()
+        if not target:
+            return [], None, "CRITICAL"
+        return [Alarm(target, message, severity)], target, severity
+    return build
+
+
+def _dual_psu_scenario(find_target):
+    """電源両系断: FW は単体ダウン、それ以外は配下へ波及"""
+    def build():
+        target = find_target()
+        if not target:
+            return [], None, "CRITICAL"
+        message = "Power Supply: Dual Loss (Device Down)"
+        if "FW" in target:
+            return [Alarm(target, message, "CRITICAL")], target, "CRITICAL"
+        return _simulate_cascade_cached(target, message), target, "CRITICAL"
+    return build
+
+
+def _wan_total_outage_scenario():
+    target = _find_router()
+    alarms = _simulate_cascade_cached(target) if target else []
+    return alarms, target, "CRITICAL"
 
-    for node_id, node in TOPOLOGY.items():
-        if node.parent_id:
-            graph.edge(node.parent_id, node_id)
-            parent_node = TOPOLOGY.get(node.parent_id)
-            if parent_node and parent_node.redundancy_group:
-                partners = [n.id for n in TOPOLOGY.values()
-                           if n.redundancy_group == parent_node.redundancy_group and n.id != parent_node.id]
-                for partner_id in partners:
-                    graph.edge(partner_id, node_id)
-    return graph
+
+def _l2sw_silent_failure_scenario():
+    target = "L2_SW_01"
+    if target not in TOPOLOGY:
+        target = find_target_node_id(TOPOLOGY, keyword="L2_SW")
+    if not (target and target in TOPOLOGY):
+        return [], None, "CRITICAL"
+    child_nodes = CHILDREN_BY_PARENT.get(target, [])
+    return [Alarm(child, "Connection Lost", "CRITICAL") for child in child_nodes], target, "CRITICAL"
+
+
+def _wan_compound_scenario():
+    target = _find_router()
+    if not target:
+        return [], None, "CRITICAL"
+    return [
+        Alarm(target, "Power Supply 1 Failed", "CRITICAL"),
+        Alarm(target, "Fan Fail", "WARNING")
+    ], target, "CRITICAL"
+
+
+def _fw_ap_simultaneous_scenario():
+    fw_node = _find_firewall()
+    ap_node = find_target_node_id(TOPOLOGY, node_type="ACCESS_POINT")
+    alarms = []
+    if fw_node:
+        alarms.append(Alarm(fw_node, "Heartbeat Loss", "WARNING"))
+    if ap_node:
+        alarms.append(Alarm(ap_node, "Connection Lost", "CRITICAL"))
+    return alarms, fw_node, "CRITICAL"
+
+
+SCENARIO_ALARM_BUILDERS = {
+    1: _wan_total_outage_scenario,
+    2: _single_alarm_scenario(_find_firewall, "Heartbeat Loss", "WARNING"),
+    3: _l2sw_silent_failure_scenario,
+    4: _single_alarm_scenario(_find_router, "Power Supply 1 Failed", "WARNING"),
+    5: _dual_psu_scenario(_find_router),
+    6: _single_alarm_scenario(_find_router, "BGP Flapping", "WARNING"),
+    7: _single_alarm_scenario(_find_router, "Fan Fail", "WARNING"),
+    8: _single_alarm_scenario(_find_router, "Memory High", "WARNING"),
+    9: _single_alarm_scenario(_find_firewall, "Power Supply 1 Failed", "WARNING"),
+    10: _dual_psu_scenario(_find_firewall),
+    11: _single_alarm_scenario(_find_firewall, "Fan Fail", "WARNING"),
+    12: _single_alarm_scenario(_find_firewall, "Memory High", "WARNING"),
+    13: _single_alarm_scenario(_find_l2_switch, "Power Supply 1 Failed", "WARNING"),
+    14: _dual_psu_scenario(_find_l2_switch),
+    15: _single_alarm_scenario(_find_l2_switch, "Fan Fail", "WARNING"),
+    16: _single_alarm_scenario(_find_l2_switch, "Memory High", "WARNING"),
+    17: _wan_compound_scenario,
+    18: _fw_ap_simultaneous_scenario,
+}
+
+# 対象機器が見つからない（生成関数が対象 None を返した）ときに表示するエラー
+# 生成結果は st.cache_data でキャッシュされるため、描画は生成関数の中では行わず呼び出し側で行う
+SCENARIO_TARGET_NOT_FOUND_ERRORS = {
+    3: "Error: L2 Switch definition not found",
+}
+
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def build_scenario_alarms(scenario_id: int):
+    """シナリオ番号に対応するアラームを生成（TOPOLOGY 固定のためシナリオごとに結果を再利用）"""
+    return SCENARIO_ALARM_BUILDERS[scenario_id]()
+
+
+def _alarm_message_key(alarms) -> tuple:
+    """アラームを機器ごとのメッセージ列に集約した推論キー ((device_id, (message, ...)), ...)"""
+    msg_map = defaultdict(list)
+    for alarm in alarms:
+        msg_map[alarm.device_id].append(alarm.message)
+    return tuple((dev_id, tuple(msgs)) for dev_id, msgs in msg_map.items())
+
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def scenario_alarm_key(scenario_id: int) -> tuple:
+    """シナリオ番号に対応する推論キー（アラームはシナリオごとに固定のため集約も一度だけ行う）"""
+    alarms, _, _ = build_scenario_alarms(scenario_id)
+    return _alarm_message_key(alarms)
+
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def scenario_alarmed_ids(scenario_id: int) -> tuple:
+    """シナリオ番号に対応するアラーム発生ノードIDのソート済みタプル（トポロジー図のキー）"""
+    return tuple(sorted(dev_id for dev_id, _ in scenario_alarm_key(scenario_id)))
+
+
+# =====================================================
+# 原因分析レポート（入力組み立て・事前生成）
+# =====================================================
+def _topology_report_context(node_id: str):
+    """レポート用のトポロジー文脈（対象ノード・親・子）とそのハッシュ値"""
+    t_node = TOPOLOGY.get(node_id)
+    t_node_dict = {
+        "id": getattr(t_node, "id", None),
+        "type": getattr(t_node, "type", None),
+        "layer": getattr(t_node, "layer", None),
+        "metadata": getattr(t_node, "metadata", {}) or {},
+        "parent": getattr(t_node, "parent", None),
+        "children": getattr(t_node, "children", []) or [],
+    } if t_node else {}
+    context = {
+        "node": t_node_dict,
+        "parent_id": t_node.parent_id if t_node else None,
+        "children_ids": list(CHILDREN_BY_PARENT.get(node_id, ())),
+    }
+    return context, _hash_text(dumps_sorted(context))
+
+
+@st.cache_resource
+def _topology_report_contexts(topology_key: tuple) -> dict:
+    """全ノード分のレポート用トポロジー文脈を一度だけ構築（node_id -> (文脈, ハッシュ値)）
+
+    topology_key はノードIDのタプル（ノード構成が変わればキャッシュも作り直す）。
+    """
+    return {node_id: _topology_report_context(node_id) for node_id in topology_key}
+
+
+def _analyst_report_inputs(scenario: str, cand: dict) -> dict:
+    """原因分析レポートの入力一式と report_cache のキーを組み立てる
+
+    コンフィグ本文はキャッシュミス時にだけ必要なため、ここでは読み込まない（キーには更新時刻を使う）。
+    """
+    # 個別生成・一括生成と同じ正規化を通し、どちらの経路でも同じキーになるようにする
+    verification_context = normalize_verification_context(cand.get("verification_log"))
+
+    t_node = TOPOLOGY.get(cand["id"])
+    # 文脈とハッシュ値は初回呼び出し時に全ノード分を構築済み（トポロジー外のIDのみその場で組み立てる）
+    snapshot = _topology_report_contexts(TOPOLOGY_KEY).get(cand["id"])
+    topology_context, topology_context_hash = snapshot or _topology_report_context(cand["id"])
+
+    # コンフィグは本文の代わりに更新時刻でキー化する
+    cache_key_analyst = compute_stable_key(
+        "analyst",
+        scenario,
+        cand.get("id"),
+        topology_context_hash,
+        device_config_mtime_ns(cand["id"]),
+        _hash_text(verification_context),
+    )
+    return {
+        "target_node": t_node,
+        "topology_context": topology_context,
+        "verification_context": verification_context,
+        "cache_key": cache_key_analyst,
+    }
+
+
+def _warm_report_cache(category: str, api_key: str) -> int:
+    """カテゴリ内の各シナリオについて、最上位候補の原因分析レポートを一括生成して report_cache に入れる
+
+    Returns:
+        新たにキャッシュしたレポート件数
+    """
+    report_cache = st.session_state.report_cache
+    pending = []
+    for scenario in SCENARIO_MAP.get(category, []):
+        scenario_id = parse_scenario_id(scenario)
+        if scenario_id not in SCENARIO_ALARM_BUILDERS:
+            continue
+        candidates = infer_root_cause_cached(scenario_alarm_key(scenario_id))
+        if not candidates:
+            continue
+        inputs = _analyst_report_inputs(scenario, candidates[0])
+        if inputs["target_node"] is None or inputs["cache_key"] in report_cache:
+            continue
+        pending.append((scenario, inputs))
+
+    reports = generate_analyst_reports_batch(
+        [
+            {"scenario": scenario, "target_node": inputs["target_node"], "verification_context": inputs["verification_context"]}
+            for scenario, inputs in pending
+        ],
+        api_key,
+    )
+    for i, report in reports.items():
+        report_cache[pending[i][1]["cache_key"]] = report
+    return len(reports)
+
+
+# =====================================================
+# チャットパネル
+# =====================================================
+@st.fragment
+def _render_chat_panel(selected_incident_candidate, target_device_id, api_key):
+    """チャットパネル（送信・クリア時の再実行をこのパネル内に限定する）"""
+    _chat_target_id = ""
+    try:
+        if selected_incident_candidate:
+            _chat_target_id = selected_incident_candidate.get("id", "") or ""
+    except Exception:
+        _chat_target_id = ""
+    if not _chat_target_id:
+        _chat_target_id = target_device_id if target_device_id else ""
+    _chat_ci = _build_ci_context_for_chat(_chat_target_id) if _chat_target_id else {}
+    if _chat_ci:
+        _vendor = _chat_ci.get("vendor", "") or "Unknown"
+        _os = _chat_ci.get("os", "") or "Unknown"
+        _model = _chat_ci.get("model", "") or "Unknown"
+        st.caption(f"対象機器: {_chat_target_id}   Vendor: {_vendor}   OS: {_os}   Model: {_model}")
+
+    q1, q2, q3 = st.columns(3)
+    if "chat_quick_text" not in st.session_state:
+        st.session_state.chat_quick_text = ""
+
+    with q1:
+        if st.button("設定バックアップ", use_container_width=True):
+            st.session_state.chat_quick_text = "この機器で、現在の設定を安全にバックアップする手順とコマンド例を教えてください。"
+    with q2:
+        if st.button("ロールバック", use_container_width=True):
+            st.session_state.chat_quick_text = "この機器で、変更をロールバックする代表的な手順（候補）と注意点を教えてください。"
+    with q3:
+        if st.button("確認コマンド", use_container_width=True):
+            st.session_state.chat_quick_text = "今回の症状を切り分けるために、まず実行すべき確認コマンド（show/diagnostic）を優先度順に教えてください。"
+
+    if st.session_state.chat_quick_text:
+        st.info("クイック質問（コピーして貼り付け）")
+        st.code(st.session_state.chat_quick_text)
+
+    if st.session_state.chat_session is None and api_key:
+        model = get_chat_model(api_key)
+        st.session_state.chat_session = model.start_chat(history=[])
+
+    tab1, tab2 = st.tabs(["💬 会話", "📝 履歴"])
+
+    with tab1:
+        if st.session_state.messages:
+            last_msg = st.session_state.messages[-1]
+            if last_msg["role"] == "assistant":
+                st.info("🤖 最新の回答")
+                with st.container(height=300):
+                    st.markdown(last_msg["content"])
+
+        st.markdown("---")
+        prompt = st.text_area(
+            "質問を入力してください:",
+            height=70,
+            placeholder="Ctrl+Enter または 送信ボタンで送信",
+            key="chat_textarea"
+        )
+
+        col1, col2, col3 = st.columns([3, 1, 1])
+        with col2:
+            send_button = st.button("送信", type="primary", use_container_width=True)
+        with col3:
+            if st.button("クリア"):
+                st.session_state.messages = _new_chat_history()
+                st.session_state.pop("last_chat_prompt_token", None)
+                st.rerun(scope="fragment")
+
+        # 同じ対象・同じ質問の再送（二重クリック等）は API を呼ばずに無視する
+        prompt_token = _hash_text(f"{(selected_incident_candidate or {}).get('id', '')}:{prompt}")
+        if send_button and prompt and prompt_token == st.session_state.get("last_chat_prompt_token"):
+            st.info("同じ質問への回答は表示済みです（質問を変更して送信してください）。")
+        elif send_button and prompt:
+            # 応答前に中断された同一質問は履歴に重複して積まない
+            last_msg = st.session_state.messages[-1] if st.session_state.messages else None
+            if not (last_msg and last_msg["role"] == "user" and last_msg["content"] == prompt):
+                st.session_state.messages.append({"role": "user", "content": prompt})
+
+            if st.session_state.chat_session:
+                target_id = ""
+                try:
+                    if selected_incident_candidate:
+                        target_id = selected_incident_candidate.get("id", "") or ""
+                except Exception:
+                    target_id = ""
+                if not target_id:
+                    try:
+                        target_id = target_device_id
+                    except Exception:
+                        target_id = ""
+                ci_json = _ci_prompt_block(target_id)
+                ci_prompt = f"""あなたはネットワーク運用（NOC/SRE）の実務者です。
+次の CI 情報と Config 抜粋を必ず参照して、具体的に回答してください。一般論だけで終わらせないでください。
+
+【CI (JSON)】
+{ci_json}
+
+【ユーザーの質問】
+{prompt}
+
+回答ルール:
+- CI/Config に基づく具体手順・コマンド例を提示する
+- 追加確認が必要なら、質問は最小限（1〜2点）に絞る
+- 不明な前提は推測せず「CIに無いので確認が必要」と明記する
+"""
+
+                # 同一プロンプト（CI+質問）の回答はセッションを跨いで再利用
+                chat_cache_key = compute_cache_hash("chat", target_id or "", compute_prompt_hash(ci_prompt))
+                cached_response = rate_limiter.get_cache(chat_cache_key)
+                if cached_response:
+                    st.session_state.messages.append({"role": "assistant", "content": cached_response})
+                    st.session_state.last_chat_prompt_token = prompt_token
+                else:
+                    try:
+                        # 本文は逐次表示（最初の片が届く前の 429/503 は再接続してリトライ）
+                        st.info("🤖 最新の回答")
+                        with st.spinner("AI が回答を生成中..."), st.container(height=300):
+                            full_response = st.write_stream(
+                                stream_text_with_retry(st.session_state.chat_session.model, ci_prompt)
+                            )
+                        if not isinstance(full_response, str):
+                            full_response = "".join(str(part) for part in full_response or [])
+                        if not full_response.strip():
+                            full_response = "AI応答が空でした（CIは渡しましたが出力が生成されませんでした）。"
+                        else:
+                            rate_limiter.set_cache(chat_cache_key, full_response)
+                        st.session_state.messages.append({"role": "assistant", "content": full_response})
+                        st.session_state.last_chat_prompt_token = prompt_token
+                    except Exception as e:
+                        st.error(f"エラーが発生しました: {e}")
+                st.rerun(scope="fragment")
+
+    with tab2:
+        if st.session_state.messages:
+            history_container = st.container(height=400)
+            with history_container:
+                for i, msg in enumerate(st.session_state.messages):
+                    icon = "🤖" if msg["role"] == "assistant" else "👤"
+                    with st.container(border=True):
+                        st.markdown(f"{icon} **{msg['role'].upper()}** (メッセージ {i+1})")
+                        st.markdown(msg["content"])
+        else:
+            st.info("会話履歴はまだありません。")
 
 
 # =====================================================
@@ -376,15 +1143,13 @@ else:
 # --- サイドバー ---
 with st.sidebar:
     st.header("⚡ Scenario Controller")
-    SCENARIO_MAP = {
-        "基本・広域障害": ["正常稼働", "1. WAN全回線断", "2. FW片系障害", "3. L2SWサイレント障害"],
-        "WAN Router": ["4. [WAN] 電源障害：片系", "5. [WAN] 電源障害：両系", "6. [WAN] BGPルートフラッピング", "7. [WAN] FAN故障", "8. [WAN] メモリリーク"],
-        "Firewall (Juniper)": ["9. [FW] 電源障害：片系", "10. [FW] 電源障害：両系", "11. [FW] FAN故障", "12. [FW] メモリリーク"],
-        "L2 Switch": ["13. [L2SW] 電源障害：片系", "14. [L2SW] 電源障害：両系", "15. [L2SW] FAN故障", "16. [L2SW] メモリリーク"],
-        "複合・その他": ["17. [WAN] 複合障害：電源＆FAN", "18. [Complex] 同時多発：FW & AP", "99. [Live] Cisco実機診断"]
-    }
     selected_category = st.selectbox("対象カテゴリ:", list(SCENARIO_MAP.keys()))
     selected_scenario = st.radio("発生シナリオ:", SCENARIO_MAP[selected_category])
+    # 大規模トポロジーでは既定でインシデント関連ノードだけを描く
+    show_full_topology = st.toggle(
+        "全体トポロジーを表示", value=not _is_large_topology(),
+        help="オフにすると、異常ノードとその上位ノード・冗長相方だけを描画します"
+    )
     st.markdown("---")
     if api_key:
         st.success("API Connected")
@@ -399,48 +1164,36 @@ if "current_scenario" not in st.session_state:
     st.session_state.current_scenario = "正常稼働"
 
 for key in ["live_result", "messages", "chat_session", "trigger_analysis", "verification_result",
-            "generated_report", "verification_log", "last_report_cand_id", "logic_engine",
+            "generated_report", "verification_log", "last_report_cand_id",
             "recovered_devices", "recovered_scenario_map", "balloons_shown", "report_cache"]:
     if key not in st.session_state:
         if key == "messages":
-            st.session_state[key] = []
+            st.session_state[key] = _new_chat_history()
         elif key in ["trigger_analysis", "balloons_shown"]:
             st.session_state[key] = False
         elif key == "report_cache":
+            st.session_state[key] = LRUCache(maxsize=REPORT_CACHE_MAX_ENTRIES)
+        elif key in ["recovered_devices", "recovered_scenario_map"]:
             st.session_state[key] = {}
         else:
             st.session_state[key] = None
 
-if "recovered_devices" not in st.session_state:
-    st.session_state.recovered_devices = {}
-if "recovered_scenario_map" not in st.session_state:
-    st.session_state.recovered_scenario_map = {}
 if "global_cache" not in st.session_state:
-    st.session_state.global_cache = {}
+    st.session_state.global_cache = LRUCache(maxsize=128)
 
 GLOBAL_CACHE = st.session_state.global_cache
 
-# エンジン初期化
-if not st.session_state.logic_engine:
-    st.session_state.logic_engine = LogicalRCA(TOPOLOGY)
-
 # シナリオ切り替え時のリセット
+# 後続処理はすべてリセット後の状態を読むため、再実行（st.rerun）は不要
 if st.session_state.current_scenario != selected_scenario:
-    st.session_state.current_scenario = selected_scenario
-    st.session_state.recovered_devices = {}
-    st.session_state.recovered_scenario_map = {}
-    st.session_state.messages = []
-    st.session_state.chat_session = None
-    st.session_state.live_result = None
-    st.session_state.trigger_analysis = False
-    st.session_state.verification_result = None
-    st.session_state.generated_report = None
-    st.session_state.verification_log = None
-    st.session_state.last_report_cand_id = None
-    st.session_state.balloons_shown = False
-    if "remediation_plan" in st.session_state:
-        del st.session_state.remediation_plan
-    st.rerun()
+    _reset_for_scenario_change(selected_scenario)
+
+# カテゴリ内シナリオの原因分析レポートを一括生成（シナリオを順に切り替える際の待ち時間を省く）
+with st.sidebar:
+    if api_key and st.button("📚 カテゴリのレポートを事前生成", help="選択中カテゴリの各シナリオについて、最上位候補のレポートをまとめて生成します"):
+        with st.spinner("レポートを一括生成中..."):
+            warmed = _warm_report_cache(selected_category, api_key)
+        st.caption(f"✅ {warmed} 件のレポートをキャッシュしました")
 
 # =====================================================
 # メインロジック
@@ -448,80 +1201,30 @@ if st.session_state.current_scenario != selected_scenario:
 alarms = []
 target_device_id = None
 root_severity = "CRITICAL"
-is_live_mode = False
-
-# 1. アラーム生成ロジック
-if "Live" in selected_scenario:
-    is_live_mode = True
-elif "WAN全回線断" in selected_scenario:
-    target_device_id = find_target_node_id(TOPOLOGY, node_type="ROUTER")
-    if target_device_id:
-        alarms = simulate_cascade_failure(target_device_id, TOPOLOGY)
-elif "FW片系障害" in selected_scenario:
-    target_device_id = find_target_node_id(TOPOLOGY, node_type="FIREWALL")
-    if target_device_id:
-        alarms = [Alarm(target_device_id, "Heartbeat Loss", "WARNING")]
-        root_severity = "WARNING"
-elif "L2SWサイレント障害" in selected_scenario:
-    target_device_id = "L2_SW_01"
-    if target_device_id not in TOPOLOGY:
-        target_device_id = find_target_node_id(TOPOLOGY, keyword="L2_SW")
-    if target_device_id and target_device_id in TOPOLOGY:
-        child_nodes = [nid for nid, n in TOPOLOGY.items() if n.parent_id == target_device_id]
-        alarms = [Alarm(child, "Connection Lost", "CRITICAL") for child in child_nodes]
-    else:
-        st.error("Error: L2 Switch definition not found")
-elif "複合障害" in selected_scenario:
-    target_device_id = find_target_node_id(TOPOLOGY, node_type="ROUTER")
-    if target_device_id:
-        alarms = [
-            Alarm(target_device_id, "Power Supply 1 Failed", "CRITICAL"),
-            Alarm(target_device_id, "Fan Fail", "WARNING")
-        ]
-elif "同時多発" in selected_scenario:
-    fw_node = find_target_node_id(TOPOLOGY, node_type="FIREWALL")
-    ap_node = find_target_node_id(TOPOLOGY, node_type="ACCESS_POINT")
-    alarms = []
-    if fw_node:
-        alarms.append(Alarm(fw_node, "Heartbeat Loss", "WARNING"))
-    if ap_node:
-        alarms.append(Alarm(ap_node, "Connection Lost", "CRITICAL"))
-    target_device_id = fw_node
-else:
-    if "[WAN]" in selected_scenario:
-        target_device_id = find_target_node_id(TOPOLOGY, node_type="ROUTER")
-    elif "[FW]" in selected_scenario:
-        target_device_id = find_target_node_id(TOPOLOGY, node_type="FIREWALL")
-    elif "[L2SW]" in selected_scenario:
-        target_device_id = find_target_node_id(TOPOLOGY, node_type="SWITCH", layer=4)
-
-    if target_device_id:
-        if "電源障害：片系" in selected_scenario:
-            alarms = [Alarm(target_device_id, "Power Supply 1 Failed", "WARNING")]
-            root_severity = "WARNING"
-        elif "電源障害：両系" in selected_scenario:
-            if "FW" in target_device_id:
-                alarms = [Alarm(target_device_id, "Power Supply: Dual Loss (Device Down)", "CRITICAL")]
-            else:
-                alarms = simulate_cascade_failure(target_device_id, TOPOLOGY, "Power Supply: Dual Loss (Device Down)")
-        elif "BGP" in selected_scenario:
-            alarms = [Alarm(target_device_id, "BGP Flapping", "WARNING")]
-            root_severity = "WARNING"
-        elif "FAN" in selected_scenario:
-            alarms = [Alarm(target_device_id, "Fan Fail", "WARNING")]
-            root_severity = "WARNING"
-        elif "メモリ" in selected_scenario:
-            alarms = [Alarm(target_device_id, "Memory High", "WARNING")]
-            root_severity = "WARNING"
 
-# 2. ★改善: バッチ処理対応の推論エンジン
-msg_map = {}
-for alarm in alarms:
-    if alarm.device_id not in msg_map:
-        msg_map[alarm.device_id] = []
-    msg_map[alarm.device_id].append(alarm.message)
+# 1. アラーム生成ロジック（シナリオ番号で生成関数を引く）
+scenario_id = parse_scenario_id(selected_scenario)
+is_live_mode = scenario_id == LIVE_SCENARIO_ID
+infer_key = ()
+alarmed_ids_key = ()
+if scenario_id in SCENARIO_ALARM_BUILDERS:
+    alarms, target_device_id, root_severity = build_scenario_alarms(scenario_id)
+    if target_device_id is None and scenario_id in SCENARIO_TARGET_NOT_FOUND_ERRORS:
+        st.error(SCENARIO_TARGET_NOT_FOUND_ERRORS[scenario_id])
+    infer_key = scenario_alarm_key(scenario_id)
+    alarmed_ids_key = scenario_alarmed_ids(scenario_id)
 
-analysis_results = st.session_state.logic_engine.infer_root_cause(msg_map)
+# 2. ★改善: バッチ処理対応の推論エンジン
+# アラームが無いシナリオ（正常稼働・ライブ診断）は推論エンジンを生成・参照せずに空の結果とする
+# アラーム構成が前回の実行と同じなら、キャッシュからの復元（コピー）も省いて前回結果を使う
+if not infer_key:
+    analysis_results = []
+elif st.session_state.get("last_infer_key") == infer_key:
+    analysis_results = st.session_state.last_infer_result
+else:
+    analysis_results = infer_root_cause_cached(infer_key)
+    st.session_state.last_infer_key = infer_key
+    st.session_state.last_infer_result = analysis_results
 
 # 3. コックピット表示
 selected_incident_candidate = None
@@ -536,37 +1239,7 @@ with col3:
     st.metric("🚨 要対応インシデント", f"{len([c for c in analysis_results if c['prob'] > 0.6])}件", "対処が必要")
 st.markdown("---")
 
-df_data = []
-for rank, cand in enumerate(analysis_results, 1):
-    status = "⚪ 監視中"
-    action = "👁️ 静観"
-
-    if cand['prob'] > 0.8:
-        status = "🔴 危険 (根本原因)"
-        action = "🚀 自動修復が可能"
-    elif cand['prob'] > 0.6:
-        status = "🟡 警告 (被疑箇所)"
-        action = "🔍 詳細調査を推奨"
-
-    if "Network/Unreachable" in cand['type'] or "Network/Secondary" in cand['type']:
-        status = "⚫ 応答なし (上位障害)"
-        action = "⛔ 対応不要 (上位復旧待ち)"
-
-    candidate_text = f"デバイス: {cand['id']} / 原因: {cand['label']}"
-    if cand.get('verification_log'):
-        candidate_text += " [🔍 Active Probe: 応答なし]"
-
-    df_data.append({
-        "順位": rank,
-        "ステータス": status,
-        "根本原因候補": candidate_text,
-        "リスクスコア": cand['prob'],
-        "推奨アクション": action,
-        "ID": cand['id'],
-        "Type": cand['type']
-    })
-
-df = pd.DataFrame(df_data)
+df = _build_incident_df(_incident_rows_key(analysis_results))
 st.info("💡 ヒント: インシデントの行をクリックすると、右側に詳細分析と復旧プランが表示されます。")
 
 event = st.dataframe(
@@ -578,16 +1251,15 @@ event = st.dataframe(
     use_container_width=True,
     hide_index=True,
     selection_mode="single-row",
-    on_select="rerun"
+    on_select="rerun",
+    key="incident_df"
 )
 
 if len(event.selection.rows) > 0:
+    # 表の行は analysis_results と同順のため、行番号でそのまま候補を引ける
     idx = event.selection.rows[0]
-    sel_row = df.iloc[idx]
-    for res in analysis_results:
-        if res['id'] == sel_row['ID'] and res['type'] == sel_row['Type']:
-            selected_incident_candidate = res
-            break
+    if idx < len(analysis_results):
+        selected_incident_candidate = analysis_results[idx]
 else:
     selected_incident_candidate = analysis_results[0] if analysis_results else None
 
@@ -611,7 +1283,11 @@ with col_map:
         current_root_node = TOPOLOGY.get(target_device_id)
         current_severity = root_severity
 
-    st.graphviz_chart(render_topology(alarms, analysis_results), use_container_width=True)
+    topology_svg = render_topology_svg(alarmed_ids_key, analysis_results, show_full_topology)
+    if topology_svg:
+        st.image(topology_svg, use_container_width=True)
+    else:
+        st.graphviz_chart(render_topology(alarmed_ids_key, analysis_results, show_full_topology), use_container_width=True)
 
     st.markdown("---")
     st.subheader("🛠️ Auto-Diagnostics")
@@ -623,23 +1299,13 @@ with col_map:
             with st.status("Agent Operating...", expanded=True) as status:
                 st.write("🔌 Connecting to device...")
                 target_node_obj = TOPOLOGY.get(target_device_id) if target_device_id else None
-                is_live = bool(st.session_state.get('api_connected')) and ('[Live]' in selected_scenario or 'Live' in selected_scenario)
+                is_live = bool(st.session_state.get('api_connected')) and is_live_mode
 
                 res = run_diagnostic_simulation(selected_scenario, target_node_obj, api_key) if is_live else run_diagnostic_simulation_no_llm(selected_scenario, target_node_obj)
+                # 表示用の切り詰めは取得時に一度だけ行い、再実行時は保存済みの文字列を使う
+                res["_short_log"] = (res.get("sanitized_log") or "")[:DIAG_LOG_DISPLAY_MAX_CHARS]
                 st.session_state.live_result = res
-
-                if res["status"] == "SUCCESS":
-                    st.write("✅ Log Acquired & Sanitized.")
-                    status.update(label="Diagnostics Complete!", state="complete", expanded=False)
-                    log_content = res.get('sanitized_log', "")
-                    verification = verify_log_content(log_content)
-                    st.session_state.verification_result = verification
-                    st.session_state.trigger_analysis = True
-                elif res["status"] == "SKIPPED":
-                    status.update(label="No Action Required", state="complete")
-                else:
-                    st.write("❌ Connection Failed.")
-                    status.update(label="Diagnostics Failed", state="error")
+                DIAG_STATUS_HANDLERS.get(res["status"], _on_diag_failed)(res, status)
             st.rerun()
 
     if st.session_state.live_result:
@@ -661,7 +1327,9 @@ with col_map:
 
                 st.divider()
                 st.caption("🔒 Raw Logs (Sanitized)")
-                st.code(res["sanitized_log"], language="text")
+                st.code(res["_short_log"], language="text")
+                if len(res["sanitized_log"]) > DIAG_LOG_DISPLAY_MAX_CHARS:
+                    st.caption(f"※ 先頭 {DIAG_LOG_DISPLAY_MAX_CHARS} 文字のみ表示しています")
         elif res["status"] == "ERROR":
             st.error(f"診断エラー: {res.get('error')}")
 
@@ -680,43 +1348,22 @@ with col_chat:
                 if st.button("📝 詳細レポートを作成 (Generate Report)"):
 
                     report_container = st.empty()
-                    target_conf = load_config_by_id(cand['id'])
-                    verification_context = cand.get("verification_log", "特になし")
-
-                    t_node = TOPOLOGY.get(cand["id"])
-                    t_node_dict = {
-                        "id": getattr(t_node, "id", None),
-                        "type": getattr(t_node, "type", None),
-                        "layer": getattr(t_node, "layer", None),
-                        "metadata": getattr(t_node, "metadata", {}) or {},
-                        "parent": getattr(t_node, "parent", None),
-                        "children": getattr(t_node, "children", []) or [],
-                    } if t_node else {}
-
-                    parent_id = t_node.parent_id if t_node else None
-                    children_ids = [
-                        nid for nid, n in TOPOLOGY.items()
-                        if getattr(n, "parent_id", None) == cand["id"]
-                    ]
-                    topology_context = {"node": t_node_dict, "parent_id": parent_id, "children_ids": children_ids}
-
-                    cache_key_analyst = "|".join([
-                        "analyst",
-                        selected_scenario,
-                        str(cand.get("id")),
-                        _hash_text(json.dumps(topology_context, ensure_ascii=False, sort_keys=True)),
-                        _hash_text(target_conf or ""),
-                        _hash_text(verification_context or ""),
-                    ])
-
-                    if cache_key_analyst in st.session_state.report_cache:
-                        full_text = st.session_state.report_cache[cache_key_analyst]
+                    report_inputs = _analyst_report_inputs(selected_scenario, cand)
+                    t_node = report_inputs["target_node"]
+                    topology_context = report_inputs["topology_context"]
+                    verification_context = report_inputs["verification_context"]
+                    cache_key_analyst = report_inputs["cache_key"]
+
+                    cached_report = st.session_state.report_cache.get(cache_key_analyst)
+                    if cached_report is not None:
+                        full_text = cached_report
                         report_container.markdown(full_text)
                     else:
                         try:
                             report_container.write("🤖 AI 分析中...")
                             placeholder = report_container.empty()
                             full_text = ""
+                            target_conf = load_config_by_id(cand['id'])
 
                             try:
                                 for chunk in generate_analyst_report_streaming(
@@ -776,15 +1423,16 @@ with col_chat:
                     remediation_container = st.empty()
                     t_node = TOPOLOGY.get(selected_incident_candidate["id"])
 
-                    cache_key_remediation = "|".join([
+                    cache_key_remediation = compute_stable_key(
                         "remediation",
                         selected_scenario,
-                        str(selected_incident_candidate.get("id")),
+                        selected_incident_candidate.get("id"),
                         _hash_text(st.session_state.generated_report or ""),
-                    ])
+                    )
 
-                    if cache_key_remediation in st.session_state.report_cache:
-                        remediation_text = st.session_state.report_cache[cache_key_remediation]
+                    cached_remediation = st.session_state.report_cache.get(cache_key_remediation)
+                    if cached_remediation is not None:
+                        remediation_text = cached_remediation
                         remediation_container.markdown(remediation_text)
                     else:
                         try:
@@ -888,8 +1536,6 @@ with col_chat:
                 is_success = "up" in st.session_state.verification_log.lower() or "ok" in st.session_state.verification_log.lower()
 
                 if is_success:
-                    st.session_state.recovered_devices = st.session_state.get("recovered_devices") or {}
-                    st.session_state.recovered_scenario_map = st.session_state.get("recovered_scenario_map") or {}
                     st.session_state.recovered_devices[target_device_id] = True
                     st.session_state.recovered_scenario_map[target_device_id] = selected_scenario
 
@@ -918,126 +1564,7 @@ with col_chat:
 
     # チャット (常時表示)
     with st.expander("💬 Chat with AI Agent", expanded=False):
-        _chat_target_id = ""
-        try:
-            if selected_incident_candidate:
-                _chat_target_id = selected_incident_candidate.get("id", "") or ""
-        except Exception:
-            _chat_target_id = ""
-        if not _chat_target_id:
-            _chat_target_id = target_device_id if target_device_id else ""
-        _chat_ci = _build_ci_context_for_chat(_chat_target_id) if _chat_target_id else {}
-        if _chat_ci:
-            _vendor = _chat_ci.get("vendor", "") or "Unknown"
-            _os = _chat_ci.get("os", "") or "Unknown"
-            _model = _chat_ci.get("model", "") or "Unknown"
-            st.caption(f"対象機器: {_chat_target_id}   Vendor: {_vendor}   OS: {_os}   Model: {_model}")
-
-        q1, q2, q3 = st.columns(3)
-        if "chat_quick_text" not in st.session_state:
-            st.session_state.chat_quick_text = ""
-
-        with q1:
-            if st.button("設定バックアップ", use_container_width=True):
-                st.session_state.chat_quick_text = "この機器で、現在の設定を安全にバックアップする手順とコマンド例を教えてください。"
-        with q2:
-            if st.button("ロールバック", use_container_width=True):
-                st.session_state.chat_quick_text = "この機器で、変更をロールバックする代表的な手順（候補）と注意点を教えてください。"
-        with q3:
-            if st.button("確認コマンド", use_container_width=True):
-                st.session_state.chat_quick_text = "今回の症状を切り分けるために、まず実行すべき確認コマンド（show/diagnostic）を優先度順に教えてください。"
-
-        if st.session_state.chat_quick_text:
-            st.info("クイック質問（コピーして貼り付け）")
-            st.code(st.session_state.chat_quick_text)
-
-        if st.session_state.chat_session is None and api_key:
-            genai.configure(api_key=api_key)
-            model = genai.GenerativeModel("gemma-3-12b-it")
-            st.session_state.chat_session = model.start_chat(history=[])
-
-        tab1, tab2 = st.tabs(["💬 会話", "📝 履歴"])
-
-        with tab1:
-            if st.session_state.messages:
-                last_msg = st.session_state.messages[-1]
-                if last_msg["role"] == "assistant":
-                    st.info("🤖 最新の回答")
-                    with st.container(height=300):
-                        st.markdown(last_msg["content"])
-
-            st.markdown("---")
-            prompt = st.text_area(
-                "質問を入力してください:",
-                height=70,
-                placeholder="Ctrl+Enter または 送信ボタンで送信",
-                key="chat_textarea"
-            )
-
-            col1, col2, col3 = st.columns([3, 1, 1])
-            with col2:
-                send_button = st.button("送信", type="primary", use_container_width=True)
-            with col3:
-                if st.button("クリア"):
-                    st.session_state.messages = []
-                    st.rerun()
-
-            if send_button and prompt:
-                st.session_state.messages.append({"role": "user", "content": prompt})
-
-                if st.session_state.chat_session:
-                    target_id = ""
-                    try:
-                        if selected_incident_candidate:
-                            target_id = selected_incident_candidate.get("id", "") or ""
-                    except Exception:
-                        target_id = ""
-                    if not target_id:
-                        try:
-                            target_id = target_device_id
-                        except Exception:
-                            target_id = ""
-                    ci = _build_ci_context_for_chat(target_id) if target_id else {}
-                    ci_prompt = f"""あなたはネットワーク運用（NOC/SRE）の実務者です。
-次の CI 情報と Config 抜粋を必ず参照して、具体的に回答してください。一般論だけで終わらせないでください。
-
-【CI (JSON)】
-{json.dumps(ci, ensure_ascii=False, indent=2)}
-
-【ユーザーの質問】
-{prompt}
-
-回答ルール:
-- CI/Config に基づく具体手順・コマンド例を提示する
-- 追加確認が必要なら、質問は最小限（1〜2点）に絞る
-- 不明な前提は推測せず「CIに無いので確認が必要」と明記する
-"""
-
-                    with st.spinner("AI が回答を生成中..."):
-                        try:
-                            response = generate_content_with_retry(st.session_state.chat_session.model, ci_prompt, stream=False)
-                            if response:
-                                full_response = response.text if hasattr(response, "text") else str(response)
-                                if not full_response.strip():
-                                    full_response = "AI応答が空でした（CIは渡しましたが出力が生成されませんでした）。"
-                                st.session_state.messages.append({"role": "assistant", "content": full_response})
-                            else:
-                                st.error("AIからの応答がありませんでした。")
-                        except Exception as e:
-                            st.error(f"エラーが発生しました: {e}")
-                    st.rerun()
-
-        with tab2:
-            if st.session_state.messages:
-                history_container = st.container(height=400)
-                with history_container:
-                    for i, msg in enumerate(st.session_state.messages):
-                        icon = "🤖" if msg["role"] == "assistant" else "👤"
-                        with st.container(border=True):
-                            st.markdown(f"{icon} **{msg['role'].upper()}** (メッセージ {i+1})")
-                            st.markdown(msg["content"])
-            else:
-                st.info("会話履歴はまだありません。")
+        _render_chat_panel(selected_incident_candidate, target_device_id, api_key)
 
 # ベイズ更新トリガー
 if st.session_state.trigger_analysis and st.session_state.live_result:
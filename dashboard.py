@@ -1,7 +1,8 @@
-import json
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Tuple
 import streamlit as st
 
+from rate_limiter import loads_json
+
 # ==========================================================
 # Dashboard 表示ロジック（v3）
 # ==========================================================
@@ -33,6 +34,12 @@ AUTO_REMEDIATION_BLOCKED_IMPACT_TYPES = {
     "UNKNOWN",
 }
 
+# impact_type -> 自動修復表示の可否（上の2集合をまとめた判定表。未登録は安全側の False）
+AUTO_REMEDIATION_POLICY: Dict[str, bool] = {
+    **{t: True for t in AUTO_REMEDIATION_ALLOWED_IMPACT_TYPES},
+    **{t: False for t in AUTO_REMEDIATION_BLOCKED_IMPACT_TYPES},
+}
+
 
 def normalize_tier(item: Dict[str, Any]) -> int:
     try:
@@ -48,24 +55,20 @@ def sort_key(item: Dict[str, Any]):
 
 
 def should_show_auto_remediation(item: Dict[str, Any]) -> bool:
-    impact_type = str(item.get("type") or item.get("impact_type") or "UNKNOWN")
+    impact_type = item.get("type") or item.get("impact_type") or "UNKNOWN"
+    if not isinstance(impact_type, str):
+        impact_type = str(impact_type)
 
-    if impact_type in AUTO_REMEDIATION_BLOCKED_IMPACT_TYPES:
-        return False
-    if impact_type in AUTO_REMEDIATION_ALLOWED_IMPACT_TYPES:
-        return True
-
-    # それ以外は安全側に倒す
-    return False
+    # 判定表に無いものは安全側に倒す
+    return AUTO_REMEDIATION_POLICY.get(impact_type, False)
 
 
 def classify_display_status(item: Dict[str, Any]) -> Dict[str, str]:
     # prob を優先して UI の色/文言を決める（tier は優先度表示に使用）
     prob = float(item.get("prob", 0.0) or 0.0)
-    impact_type = str(item.get("type") or "UNKNOWN")
 
     # サイレント障害は黄色扱い（要調査）
-    if impact_type == "Network/SilentFailure":
+    if item.get("type") == "Network/SilentFailure":
         return {"severity": "🟡 警告 (被疑箇所)", "color": "YELLOW"}
 
     if prob >= 0.85:
@@ -102,41 +105,74 @@ def render_details(item: Dict[str, Any]):
             st.json(item)
 
 
-def render_incident_table(results: List[Dict[str, Any]]):
+def group_by_tier(results: List[Dict[str, Any]]) -> List[Tuple[int, List[Tuple[Dict[str, Any], str]]]]:
     """
-    AIOps インシデント・コックピット表示（tier で折りたたみ）
+    表示順に並べて tier ごとにまとめ、各行の見出し Markdown も組み立てておく
+
+    Returns:
+        [(tier, [(item, 見出しMarkdown), ...]), ...]（tier 昇順）
     """
-    st.subheader("🧠 AIOps インシデント・コックピット")
+    import numpy as np
 
-    results = sorted(results, key=sort_key)
+    # sort_key と同じ順序（tier 昇順 → prob 降順、同値は元の順）を一括で求める
+    n = len(results)
+    tier_arr = np.fromiter((normalize_tier(item) for item in results), dtype=np.int64, count=n)
+    probs = np.fromiter((float(item.get("prob", 0.0) or 0.0) for item in results), dtype=np.float64, count=n)
+    order = np.lexsort((-probs, tier_arr))
 
     # tier ごとにグルーピング
     tiers: Dict[int, List[Dict[str, Any]]] = {}
-    for item in results:
-        t = normalize_tier(item)
-        tiers.setdefault(t, []).append(item)
+    for i in order.tolist():
+        tiers.setdefault(int(tier_arr[i]), []).append(results[i])
 
-    # tier の表示順（小さいほど上位）
+    grouped = []
     for tier in sorted(tiers.keys()):
-        title = f"Tier {tier}（優先度 {'高' if tier == 1 else '中' if tier == 2 else '低'}）"
-        expanded = True if tier == 1 else False
-
-        with st.expander(title, expanded=expanded):
-            items = tiers[tier]
-            for idx, item in enumerate(items, start=1):
-                ui = classify_display_status(item)
-                auto_flag = "🚀 自動修復が可能" if should_show_auto_remediation(item) else "🧑 手動対応 / 承認が必要"
-
-                st.markdown(
-                    f"""**{idx}. {ui['severity']}**  
+        rows = []
+        for idx, item in enumerate(tiers[tier], start=1):
+            ui = classify_display_status(item)
+            auto_flag = "🚀 自動修復が可能" if should_show_auto_remediation(item) else "🧑 手動対応 / 承認が必要"
+            rows.append((item, f"""**{idx}. {ui['severity']}**  
 - デバイス: `{item.get('id')}`  
 - 原因: `{item.get('label')}`  
 - 確信度: `{item.get('prob')}`  
 - 分類: `{item.get('type')}`  
 - 理由: {item.get('reason')}  
 - 対応: {auto_flag}
-"""
-                )
+"""))
+        grouped.append((tier, rows))
+    return grouped
+
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def load_tier_view(raw: bytes):
+    """
+    アップロードされた JSON を解析して tier ごとの表示行を構築
+    （行選択などの再実行では同じファイルを再解析・再整列しない）
+
+    Returns:
+        group_by_tier() の戻り値。JSON が配列でなければ None
+    """
+    # バイト列のまま解析する（orjson があれば高速パーサを使う）
+    results = loads_json(raw)
+    if not isinstance(results, list):
+        return None
+    return group_by_tier(results)
+
+
+def render_tiers(grouped: List[Tuple[int, List[Tuple[Dict[str, Any], str]]]]):
+    """
+    AIOps インシデント・コックピット表示（tier で折りたたみ）
+    """
+    st.subheader("🧠 AIOps インシデント・コックピット")
+
+    # tier の表示順（小さいほど上位）
+    for tier, rows in grouped:
+        title = f"Tier {tier}（優先度 {'高' if tier == 1 else '中' if tier == 2 else '低'}）"
+        expanded = True if tier == 1 else False
+
+        with st.expander(title, expanded=expanded):
+            for item, summary in rows:
+                st.markdown(summary)
 
                 # ここが追加：詳細欄（AI Analyst Report を表示）
                 render_details(item)
@@ -144,6 +180,13 @@ def render_incident_table(results: List[Dict[str, Any]]):
                 st.divider()
 
 
+def render_incident_table(results: List[Dict[str, Any]]):
+    """
+    AIOps インシデント・コックピット表示（tier で折りたたみ）
+    """
+    render_tiers(group_by_tier(results))
+
+
 def main():
     st.set_page_config(page_title="AIOps Incident Cockpit", layout="wide")
 
@@ -156,11 +199,11 @@ def main():
         return
 
     try:
-        results = json.load(uploaded)
-        if not isinstance(results, list):
+        grouped = load_tier_view(uploaded.getvalue())
+        if grouped is None:
             st.error("JSON は配列形式（list）である必要があります。")
             return
-        render_incident_table(results)
+        render_tiers(grouped)
     except Exception as e:
         st.error(f"JSON 読み込みエラー: {e}")
 
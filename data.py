@@ -6,7 +6,9 @@ Google Antigravity AIOps Agent - Data Module (Optimized Final)
 import json
 import os
 import logging
-from typing import Dict, Optional, Any
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, List, Optional, Any
 from dataclasses import dataclass, field
 
 # =====================================================
@@ -23,6 +25,12 @@ class TopologyConstants:
     DEFAULT_TYPE = "UNKNOWN"
     MAX_LAYER = 100
 
+class ConfigConstants:
+    CONFIG_ROOT = Path("configs").resolve()
+    FALLBACK_ROOT = Path.cwd().resolve()
+    CONFIG_SUFFIX = ".txt"
+    CACHE_SIZE = 128
+
 # =====================================================
 # データクラス定義
 # =====================================================
@@ -176,7 +184,152 @@ def _has_circular_reference(node: NetworkNode, topology: Dict[str, NetworkNode],
         return _has_circular_reference(parent, topology, visited)
     return False
 
+# =====================================================
+# 機器コンフィグ読み込み関数
+# =====================================================
+def _config_candidate_paths(device_id: str) -> List[str]:
+    """機器コンフィグの探索パス候補 (configs/ 配下 → カレント)
+
+    device_id はファイル名部分のみを使い、解決後のパスが各ルート外を指すもの
+    (シンボリックリンク経由の脱出など) は候補から除外する。
+    """
+    filename = f"{os.path.basename(device_id)}{ConfigConstants.CONFIG_SUFFIX}"
+    paths = []
+    for root in (ConfigConstants.CONFIG_ROOT, ConfigConstants.FALLBACK_ROOT):
+        path = (root / filename).resolve()
+        if path.is_relative_to(root):
+            paths.append(str(path))
+    return paths
+
+def _stat_mtime_ns(path: str) -> int:
+    """ファイルの更新時刻 (存在しなければ 0)"""
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return 0
+
+@lru_cache(maxsize=ConfigConstants.CACHE_SIZE)
+def _read_config_file(path: str, mtime_ns: int) -> Optional[str]:
+    """コンフィグファイルの読み込み (mtime をキーに含め、更新時は自動で再読込)"""
+    try:
+        # バイト列で一括読み込みし、改行変換は CRLF を含む場合だけ行う
+        content = Path(path).read_bytes().decode('utf-8')
+    except Exception as e:
+        logger.error(f"Error reading config {path}: {e}")
+        return None
+    if '\r' in content:
+        content = content.replace('\r\n', '\n').replace('\r', '\n')
+    return content
+
+def read_config_file(path: str) -> Optional[str]:
+    """指定パスのコンフィグを mtime 検証付きキャッシュ経由で読み込み (見つからなければ None)"""
+    mtime_ns = _stat_mtime_ns(path)
+    if not mtime_ns:
+        return None
+    return _read_config_file(path, mtime_ns)
+
+def load_device_config(device_id: str) -> Optional[str]:
+    """機器コンフィグを読み込み (見つからなければ None)"""
+    for path in _config_candidate_paths(device_id):
+        content = read_config_file(path)
+        if content is not None:
+            return content
+    return None
+
+def device_config_mtime_ns(device_id: str) -> int:
+    """機器コンフィグの更新時刻 (見つからなければ 0)。キャッシュキー用"""
+    for path in _config_candidate_paths(device_id):
+        mtime_ns = _stat_mtime_ns(path)
+        if mtime_ns:
+            return mtime_ns
+    return 0
+
+# =====================================================
+# トポロジー索引構築関数
+# =====================================================
+def build_redundancy_groups(topology: Dict[str, NetworkNode]) -> Dict[str, List[str]]:
+    """冗長グループから所属ノード一覧への索引を構築 (redundancy_group -> [node_id, ...])"""
+    group_members: Dict[str, List[str]] = {}
+    for node_id, node in topology.items():
+        if node.redundancy_group:
+            group_members.setdefault(node.redundancy_group, []).append(node_id)
+    return group_members
+
+def build_redundancy_partners(topology: Dict[str, NetworkNode],
+                              group_members: Optional[Dict[str, List[str]]] = None) -> Dict[str, List[str]]:
+    """冗長グループの相方ノード一覧を構築 (node_id -> [partner_id, ...])"""
+    if group_members is None:
+        group_members = build_redundancy_groups(topology)
+
+    return {
+        node_id: [m for m in group_members[node.redundancy_group] if m != node_id]
+        for node_id, node in topology.items()
+        if node.redundancy_group
+    }
+
+def build_children_index(topology: Dict[str, NetworkNode]) -> Dict[str, List[str]]:
+    """親ノードから直下の子ノード一覧への索引を構築 (parent_id -> [child_id, ...])"""
+    children: Dict[str, List[str]] = {}
+    for node_id, node in topology.items():
+        if node.parent_id:
+            children.setdefault(node.parent_id, []).append(node_id)
+    return children
+
+def build_attribute_index(topology: Dict[str, NetworkNode], attr: str) -> Dict[Any, List[str]]:
+    """ノード属性値からノードID一覧への索引を構築 (値 -> [node_id, ...]、トポロジーの定義順)"""
+    index: Dict[Any, List[str]] = {}
+    for node_id, node in topology.items():
+        index.setdefault(getattr(node, attr), []).append(node_id)
+    return index
+
+# =====================================================
+# ノード検索関数
+# =====================================================
+def _node_matches(node_id: str, node: NetworkNode, node_type: Optional[str],
+                  layer: Optional[int], keyword: Optional[str]) -> bool:
+    """ノードが検索条件 (種別・レイヤー・キーワード) をすべて満たすか"""
+    if node_type and node.type != node_type:
+        return False
+    if layer and node.layer != layer:
+        return False
+    if keyword:
+        return keyword in node_id or any(
+            isinstance(v, str) and keyword in v for v in node.metadata.values()
+        )
+    return True
+
+def find_node_id(topology: Dict[str, NetworkNode], node_type: Optional[str] = None,
+                 layer: Optional[int] = None, keyword: Optional[str] = None) -> Optional[str]:
+    """トポロジーから条件に合う最初のノードIDを検索"""
+    for node_id, node in topology.items():
+        if _node_matches(node_id, node, node_type, layer, keyword):
+            return node_id
+    return None
+
+@lru_cache(maxsize=256)
+def find_topology_node_id(node_type: Optional[str] = None, layer: Optional[int] = None,
+                          keyword: Optional[str] = None) -> Optional[str]:
+    """モジュールの TOPOLOGY に対する find_node_id のメモ化版 (TOPOLOGY は起動後不変)
+
+    種別・レイヤー索引で候補を絞ってから残りの条件を照合する (候補の順序は定義順のまま)。
+    """
+    if node_type:
+        candidates = NODES_BY_TYPE.get(node_type, ())
+    elif layer:
+        candidates = NODES_BY_LAYER.get(layer, ())
+    else:
+        candidates = TOPOLOGY
+    for node_id in candidates:
+        if _node_matches(node_id, TOPOLOGY[node_id], node_type, layer, keyword):
+            return node_id
+    return None
+
 # =====================================================
 # グローバル変数
 # =====================================================
 TOPOLOGY = load_topology_from_json()
+REDUNDANCY_GROUPS = build_redundancy_groups(TOPOLOGY)
+REDUNDANCY_PARTNERS = build_redundancy_partners(TOPOLOGY, REDUNDANCY_GROUPS)
+CHILDREN_BY_PARENT = build_children_index(TOPOLOGY)
+NODES_BY_TYPE = build_attribute_index(TOPOLOGY, "type")
+NODES_BY_LAYER = build_attribute_index(TOPOLOGY, "layer")
@@ -18,14 +18,16 @@ from enum import Enum
 from typing import List, Dict, Any, Optional, Tuple
 from dataclasses import dataclass
 
-import google.generativeai as genai
+from data import read_config_file
+from network_ops import get_generative_model, extract_json_payload
 
 # レートリミッターのインポート
 from rate_limiter import (
     GlobalRateLimiter,
     rate_limited_with_retry,
     estimate_tokens,
-    check_input_limit
+    check_input_limit,
+    dumps_sorted
 )
 
 logger = logging.getLogger(__name__)
@@ -37,6 +39,10 @@ MODEL_NAME = "gemma-3-12b-it"  # ★統一されたモデル名
 MAX_BATCH_SIZE = 5             # バッチ処理の最大デバイス数
 MAX_PROMPT_TOKENS = 100000     # プロンプト最大トークン数（安全マージン込み）
 
+# 接続断を示すアラーム文言（大文字小文字は区別しない）
+CONNECTION_LOSS_KEYWORDS = ("connection lost", "link down", "port down", "unreachable")
+_CONNECTION_LOSS_RE = re.compile("|".join(map(re.escape, CONNECTION_LOSS_KEYWORDS)), re.IGNORECASE)
+
 
 class HealthStatus(Enum):
     NORMAL = "GREEN"
@@ -144,16 +150,16 @@ class LogicalRCA:
     # LLM init
     # ----------------------------
     def _ensure_api_configured(self) -> bool:
-        if self._api_configured:
-            return True
         api_key = os.environ.get("GOOGLE_API_KEY")
         if not api_key:
-            return False
+            return self._api_configured
         try:
-            genai.configure(api_key=api_key)
-            self.model = genai.GenerativeModel(MODEL_NAME)
-            self._api_configured = True
-            logger.info(f"API configured with model: {MODEL_NAME}")
+            # configure はプロセス全体の設定のため、他のキーに切り替わっていても
+            # 呼び出しのたびにファクトリ経由で取得し直してこのキーを有効にする
+            self.model = get_generative_model(api_key, MODEL_NAME)
+            if not self._api_configured:
+                self._api_configured = True
+                logger.info(f"API configured with model: {MODEL_NAME}")
             return True
         except Exception as e:
             logger.error(f"API Configuration Error: {e}")
@@ -170,13 +176,11 @@ class LogicalRCA:
 
     def _read_config(self, device_id: str) -> str:
         config_path = os.path.join(self.config_dir, f"{device_id}.txt")
-        if os.path.exists(config_path):
-            try:
-                with open(config_path, "r", encoding="utf-8") as f:
-                    return f.read()[:2000]  # 最大2000文字に制限
-            except Exception as e:
-                return f"Error reading config: {str(e)}"
-        return "Config file not found."
+        # mtime 検証付きキャッシュ経由（同一ファイルの再読込を省く）
+        content = read_config_file(config_path)
+        if content is None:
+            return "Config file not found."
+        return content[:2000]  # 最大2000文字に制限
 
     # ----------------------------
     # Sanitization
@@ -356,7 +360,7 @@ class LogicalRCA:
         # キャッシュチェック
         cache_key = self._rate_limiter.compute_cache_key(
             "batch_analysis", 
-            json.dumps(devices_alerts, sort_keys=True)
+            dumps_sorted(devices_alerts)
         )
         cached = self._rate_limiter.get_cache(cache_key)
         if cached:
@@ -380,7 +384,7 @@ class LogicalRCA:
 冗長機能によりサービス維持(WARNING)されているか、または正常(NORMAL)かを判定してください。
 
 ### 判定対象デバイス一覧
-{json.dumps(devices_info, ensure_ascii=False, indent=2)}
+{json.dumps(devices_info, ensure_ascii=False, separators=(",", ":"))}
 
 ### 判定ルール
 - "冗長が効いている（サービス継続）"と判断できる限り、CRITICALにしない
@@ -407,23 +411,18 @@ class LogicalRCA:
 
         try:
             # レート制限待機
-            if not self._rate_limiter.wait_for_slot():
+            if not self._rate_limiter.acquire():
                 raise RuntimeError("Rate limit exceeded")
             
-            self._rate_limiter.record_request()
-            
-            response = self.model.generate_content(
-                prompt, 
-                generation_config={"response_mime_type": "application/json"}
-            )
-            response_text = response.text.strip()
-            
-            # JSONパース
-            if response_text.startswith("```"):
-                response_text = re.sub(r'^```\w*\n?', '', response_text)
-                response_text = re.sub(r'\n?```$', '', response_text)
-            
-            result_list = json.loads(response_text)
+            with self._rate_limiter.concurrency_slot():
+                response = self.model.generate_content(
+                    prompt, 
+                    generation_config={"response_mime_type": "application/json"}
+                )
+            # JSONパース（前後の説明文・コードフェンスは読み飛ばす）
+            result_list = extract_json_payload(response.text, list)
+            if result_list is None:
+                raise ValueError("No JSON array in AI response")
             
             # 結果をマッピング
             results = {}
@@ -482,13 +481,7 @@ class LogicalRCA:
     # Silent failure inference
     # ==========================================================
     def _is_connection_loss(self, msg: str) -> bool:
-        msg_l = msg.lower()
-        return (
-            "connection lost" in msg_l
-            or "link down" in msg_l
-            or "port down" in msg_l
-            or "unreachable" in msg_l
-        )
+        return _CONNECTION_LOSS_RE.search(msg) is not None
 
     def _detect_silent_failures(self, msg_map: Dict[str, List[str]]) -> Dict[str, Dict[str, Any]]:
         """親自身にアラームが無いのに、配下の複数子がConnection Lostを出しているなら親を疑う"""
@@ -5,9 +5,13 @@ Google Antigravity AIOps Agent - Logic Module (Optimized Final)
 """
 
 import logging
+from collections import deque
 from typing import List, Dict, Set, Optional
 from dataclasses import dataclass, field
-from data import TOPOLOGY, NetworkNode
+from data import (
+    TOPOLOGY, NetworkNode, CHILDREN_BY_PARENT, REDUNDANCY_GROUPS,
+    build_children_index, build_redundancy_groups,
+)
 
 # =====================================================
 # ロギング設定
@@ -76,6 +80,13 @@ class CausalInferenceEngine:
             raise ValueError("Topology cannot be empty")
         
         self.topology = topology
+        # 子ノード・冗長グループの索引（モジュールの TOPOLOGY なら構築済みのものを共有）
+        if topology is TOPOLOGY:
+            self._children = CHILDREN_BY_PARENT
+            self._groups = REDUNDANCY_GROUPS
+        else:
+            self._children = build_children_index(topology)
+            self._groups = build_redundancy_groups(topology)
         logger.info(f"CausalInferenceEngine initialized with {len(topology)} nodes")
     
     def analyze_alarms(self, alarms: List[Alarm]) -> InferenceResult:
@@ -159,10 +170,7 @@ class CausalInferenceEngine:
         alarm_map: Dict[str, Alarm]
     ) -> InferenceResult:
         """冗長性構成（HA）の分析"""
-        group_members = [
-            n for n in self.topology.values() 
-            if n.redundancy_group == node.redundancy_group
-        ]
+        group_members = [self.topology[nid] for nid in self._groups.get(node.redundancy_group, ())]
         down_members = [n for n in group_members if n.id in alarmed_ids]
         
         # エラー詳細の構築
@@ -206,10 +214,10 @@ class CausalInferenceEngine:
         parent_node = self.topology.get(parent_id)
         if not parent_node: return None
         
-        children = [n for n in self.topology.values() if n.parent_id == parent_id]
+        children = self._children.get(parent_id, ())
         if not children: return None
         
-        children_down = sum(1 for c in children if c.id in alarmed_ids)
+        children_down = sum(1 for c in children if c in alarmed_ids)
         
         if children_down == len(children):
             return InferenceResult(
@@ -243,23 +251,20 @@ def simulate_cascade_failure(
     root_alarm = Alarm(root_cause_id, custom_message, "CRITICAL")
     generated_alarms.append(root_alarm)
     
-    # BFSで子デバイスを探索
-    queue = [root_cause_id]
+    # BFSで子デバイスを探索（親→子の索引で直下の子だけを引く）
+    children_by_parent = CHILDREN_BY_PARENT if topology is TOPOLOGY else build_children_index(topology)
+    queue = deque([root_cause_id])
     processed = {root_cause_id}
     
     while queue:
-        current_parent_id = queue.pop(0)
-        children = [
-            n for n in topology.values() 
-            if n.parent_id == current_parent_id
-        ]
+        current_parent_id = queue.popleft()
         
-        for child in children:
-            if child.id not in processed:
-                child_alarm = Alarm(child.id, "Unreachable", "WARNING")
+        for child_id in children_by_parent.get(current_parent_id, ()):
+            if child_id not in processed:
+                child_alarm = Alarm(child_id, "Unreachable", "WARNING")
                 generated_alarms.append(child_alarm)
-                queue.append(child.id)
-                processed.add(child.id)
+                queue.append(child_id)
+                processed.add(child_id)
                 
     return generated_alarms
 
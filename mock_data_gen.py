@@ -1,9 +1,14 @@
 import pandas as pd
 import random
+from itertools import accumulate
+from typing import Optional
 
 # 生成するデータ数
 NUM_SAMPLES = 6000 
 
+# 乱数シード（None なら実行ごとに異なるデータ。整数を指定すると毎回同じ学習データを生成する）
+RANDOM_SEED: Optional[int] = None
+
 # ■ 世界の法則（シナリオ定義）
 SCENARIOS = [
     # 1. WANルーター物理故障
@@ -81,28 +86,31 @@ SCENARIOS = [
     }
 ]
 
-def generate_mock_data():
+# シナリオ選択用の累積重み（サンプルごとに作り直さない）
+SCENARIO_CUM_WEIGHTS = list(accumulate(s["weight"] for s in SCENARIOS))
+
+def generate_mock_data(seed: Optional[int] = RANDOM_SEED):
     data = []
-    print(f"Generating {NUM_SAMPLES} training samples based on World Model...")
+    rng = random.Random(seed)
+    print(f"Generating {NUM_SAMPLES} training samples based on World Model (seed={seed})...")
     
-    for _ in range(NUM_SAMPLES):
-        scenario = random.choices(SCENARIOS, weights=[s["weight"] for s in SCENARIOS])[0]
-        
+    # シナリオは全サンプル分をまとめて抽選する
+    for scenario in rng.choices(SCENARIOS, cum_weights=SCENARIO_CUM_WEIGHTS, k=NUM_SAMPLES):
         r_id = scenario['root_cause_id']
         if r_id == "L2_SW":
-            r_id = random.choice(["L2_SW_01", "L2_SW_02", "AP_01", "AP_02"]) # APも混ぜる
+            r_id = rng.choice(["L2_SW_01", "L2_SW_02", "AP_01", "AP_02"]) # APも混ぜる
             
         root_key = f"{r_id}::{scenario['root_cause_type']}"
         
         for (ev_type, ev_val), prob in scenario["probabilities"].items():
-            if random.random() < prob:
+            if rng.random() < prob:
                 data.append({
                     "RootCause": root_key,
                     "EvidenceType": ev_type,
                     "EvidenceValue": ev_val
                 })
         
-        if random.random() < 0.05:
+        if rng.random() < 0.05:
             data.append({
                 "RootCause": root_key,
                 "EvidenceType": "log",
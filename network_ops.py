@@ -11,23 +11,26 @@ AIOps Agent - Network Operations Module (Improved v2 - Final Optimized)
 """
 
 import re
-import os
 import time
 import json
 import hashlib
 import logging
 import concurrent.futures
-from typing import Dict, List, Optional, Generator, Any
+from functools import lru_cache
+from typing import TYPE_CHECKING, Dict, List, Optional, Generator, Any
 from enum import Enum
 
-import google.generativeai as genai
-from netmiko import ConnectHandler
+if TYPE_CHECKING:
+    import google.generativeai as genai
 
+from data import load_device_config, device_config_mtime_ns
 from rate_limiter import (
     GlobalRateLimiter,
     rate_limited_with_retry,
     RateLimitConfig,
-    estimate_tokens
+    compute_backoff_delay,
+    estimate_tokens,
+    loads_json
 )
 
 logger = logging.getLogger(__name__)
@@ -36,6 +39,7 @@ logger = logging.getLogger(__name__)
 # 定数・設定
 # =====================================================
 MODEL_NAME = "gemma-3-12b-it"
+REPORT_BATCH_SIZE = 4          # 一括レポート生成で1プロンプトにまとめる件数
 
 SANDBOX_DEVICE = {
     'device_type': 'cisco_nxos',
@@ -84,8 +88,7 @@ class RemediationResult:
 # グローバル初期化
 # =====================================================
 _rate_limiter: Optional[GlobalRateLimiter] = None
-_model: Optional[genai.GenerativeModel] = None
-_api_configured = False
+_model_api_key: Optional[str] = None
 
 
 def _get_rate_limiter() -> GlobalRateLimiter:
@@ -95,21 +98,51 @@ def _get_rate_limiter() -> GlobalRateLimiter:
     return _rate_limiter
 
 
-def _ensure_api_configured(api_key: str) -> Optional[genai.GenerativeModel]:
-    global _model, _api_configured
-    if _api_configured and _model:
-        return _model
+@lru_cache(maxsize=8)
+def _cached_generative_model(api_key: str, model_name: str,
+                             temperature: Optional[float]) -> "genai.GenerativeModel":
+    """API キー・モデル名・温度の組ごとに GenerativeModel を1回だけ生成する（configure は行わない）"""
+    import google.generativeai as genai
+
+    if temperature is None:
+        return genai.GenerativeModel(model_name)
+    return genai.GenerativeModel(model_name, generation_config={"temperature": temperature})
+
+
+def get_generative_model(api_key: str, model_name: str = MODEL_NAME,
+                         temperature: Optional[float] = None) -> "genai.GenerativeModel":
+    """GenerativeModel の共通ファクトリ
+
+    モデル生成はすべてここを経由させ、API キー・モデル名・温度の組ごとに生成済みモデルを使い回す。
+    genai.configure はプロセス全体の設定のため、キャッシュ済みモデルを返す場合も毎回
+    呼び出し元のキーで configure し直す（キー A→B→A と切り替えても A が有効になる）。
+    SDK（grpc/protobuf を含む）の読み込みは初回のモデル生成まで遅延させる。
+    """
+    import google.generativeai as genai
+
+    genai.configure(api_key=api_key)
+    return _cached_generative_model(api_key, model_name, temperature)
+
+
+def _ensure_api_configured(api_key: str) -> Optional["genai.GenerativeModel"]:
+    """解析用モデルを取得（キー未指定時は直近に使ったキーを流用）
+
+    チャットなど他の経路で別のキーが configure されていても、毎回ファクトリ経由で
+    取得し直してこのキーを有効にする。
+    """
+    global _model_api_key
+    api_key = api_key or _model_api_key
     if not api_key:
         return None
     try:
-        genai.configure(api_key=api_key)
-        _model = genai.GenerativeModel(MODEL_NAME, generation_config={"temperature": 0.0})
-        _api_configured = True
-        logger.info(f"API configured with model: {MODEL_NAME}")
-        return _model
+        model = get_generative_model(api_key, MODEL_NAME, 0.0)
     except Exception as e:
         logger.error(f"API Configuration Error: {e}")
         return None
+    if api_key != _model_api_key:
+        _model_api_key = api_key
+        logger.info(f"API configured with model: {MODEL_NAME}")
+    return model
 
 
 # =====================================================
@@ -131,11 +164,81 @@ def sanitize_output(text: str) -> str:
     return text
 
 
+@lru_cache(maxsize=64)
+def _sanitized_config_excerpt(device_id: str, mtime_ns: int, max_chars: int) -> str:
+    content = load_device_config(device_id)
+    if not content:
+        return ""
+    # 秘密情報が切り詰め位置で分断されないよう、サニタイズしてから切り詰める
+    return sanitize_output(content)[:max_chars]
+
+
+def sanitized_config_excerpt(device_id: str, max_chars: int = 3000) -> str:
+    """プロンプト埋め込み用のサニタイズ済みConfig抜粋（見つからなければ空文字）
+
+    サニタイズと切り詰めはファイル更新時刻ごとに一度だけ行う。
+    """
+    return _sanitized_config_excerpt(device_id, device_config_mtime_ns(device_id), max_chars)
+
+
 def compute_cache_hash(scenario: str, device_id: str, extra: str = "") -> str:
     content = f"{scenario}|{device_id}|{extra}"
     return hashlib.md5(content.encode()).hexdigest()
 
 
+def compute_prompt_hash(prompt: str) -> str:
+    """プロンプトを正規化してハッシュ化（行末空白・連続空行の差異は同一視）"""
+    lines = [line.rstrip() for line in (prompt or "").strip().splitlines()]
+    canonical = re.sub(r'\n{3,}', '\n\n', "\n".join(lines))
+    return hashlib.blake2b(canonical.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def compute_text_hash(text: str) -> str:
+    """キャッシュキー用の短いハッシュ値（暗号強度は不要なため高速な blake2b を使う）"""
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=8).hexdigest()
+
+
+def compute_stable_key(*parts) -> str:
+    """文字列・数値・タプルの並びから固定長のキャッシュキーを作る（JSON 直列化を経由しない）"""
+    return hashlib.blake2b(repr(parts).encode("utf-8"), digest_size=16).hexdigest()
+
+
+_JSON_DECODER = json.JSONDecoder()
+
+
+def extract_json_payload(text: str, expected_type: type = dict) -> Optional[Any]:
+    """LLM応答テキストから最初の JSON 値（expected_type 型）を取り出す。見つからなければ None
+
+    前後の説明文やコードフェンスは読み飛ばし、raw_decode で開き括弧の位置から前方に一度だけ解析する。
+    ```json フェンスがあれば探索開始位置をそこに寄せる。
+    """
+    if not text:
+        return None
+    opener = "[" if expected_type is list else "{"
+    # 応答全体が JSON のみ（response_mime_type 指定時など）なら一括で解析する
+    stripped = text.strip()
+    if stripped.startswith(opener):
+        try:
+            obj = loads_json(stripped)
+        except ValueError:
+            pass
+        else:
+            if isinstance(obj, expected_type):
+                return obj
+    fence = text.find("```json")
+    i = text.find(opener, fence if fence >= 0 else 0)
+    while i >= 0:
+        try:
+            obj, end = _JSON_DECODER.raw_decode(text, i)
+        except ValueError:
+            i = text.find(opener, i + 1)
+            continue
+        if isinstance(obj, expected_type):
+            return obj
+        i = text.find(opener, end)
+    return None
+
+
 def filter_hallucination(text: str) -> str:
     """AI生成テキストから不要な免責事項等を除去"""
     patterns = [
@@ -174,7 +277,7 @@ def validate_response(response) -> bool:
 # LLM呼び出し関数（レートリミッター統合）
 # =====================================================
 def _call_llm_with_rate_limit(
-    model: genai.GenerativeModel,
+    model: "genai.GenerativeModel",
     prompt: str,
     stream: bool = False,
     max_retries: int = 3
@@ -188,14 +291,13 @@ def _call_llm_with_rate_limit(
     for attempt in range(max_retries + 1):
         try:
             # レート制限待機
-            if not limiter.wait_for_slot(timeout=120):
+            if not limiter.acquire(timeout=120):
                 raise RuntimeError("Rate limit timeout")
             
-            limiter.record_request()
-            
+            # ストリーミングは応答を読み切るまで同時実行数の枠を保持する
             if stream:
-                return model.generate_content(prompt, stream=True)
-            else:
+                return limiter.stream_in_slot(lambda: model.generate_content(prompt, stream=True))
+            with limiter.concurrency_slot():
                 return model.generate_content(prompt)
         
         except Exception as e:
@@ -205,7 +307,7 @@ def _call_llm_with_rate_limit(
             should_retry = any(x in error_msg for x in ['429', '503', 'overloaded', 'rate', 'quota'])
             
             if should_retry and attempt < max_retries:
-                delay = min(config.retry_base_delay * (2 ** attempt), config.retry_max_delay)
+                delay = compute_backoff_delay(attempt, config.retry_base_delay, config.retry_max_delay)
                 logger.warning(f"Retry {attempt + 1}/{max_retries}: waiting {delay:.1f}s after: {e}")
                 time.sleep(delay)
             else:
@@ -214,6 +316,40 @@ def _call_llm_with_rate_limit(
     return None
 
 
+def call_llm_many(
+    model: "genai.GenerativeModel",
+    prompts: List[str],
+    max_workers: Optional[int] = None
+) -> List[Any]:
+    """互いに独立した複数プロンプトを並列に呼び出す（非ストリーミング）
+
+    各呼び出しは _call_llm_with_rate_limit を通るため、RPM/RPD と同時実行数の上限はそのまま守られる。
+    結果は prompts と同順のリストで、失敗した要素は例外オブジェクトになる。
+    """
+    if not prompts:
+        return []
+    if len(prompts) == 1:
+        try:
+            return [_call_llm_with_rate_limit(model, prompts[0])]
+        except Exception as e:
+            return [e]
+
+    workers = max_workers or _get_rate_limiter().config.max_concurrent
+    results: List[Any] = [None] * len(prompts)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(workers, len(prompts))) as executor:
+        future_to_index = {
+            executor.submit(_call_llm_with_rate_limit, model, prompt): i
+            for i, prompt in enumerate(prompts)
+        }
+        for future in concurrent.futures.as_completed(future_to_index):
+            i = future_to_index[future]
+            try:
+                results[i] = future.result()
+            except Exception as e:
+                results[i] = e
+    return results
+
+
 # =====================================================
 # 障害ログ生成（キャッシュ付き）
 # =====================================================
@@ -295,8 +431,9 @@ def predict_initial_symptoms(scenario_name: str, api_key: str) -> Dict:
 
     try:
         response = _call_llm_with_rate_limit(model, prompt, stream=False)
-        text = response.text.replace("```json", "").replace("```", "").strip()
-        result = json.loads(text)
+        result = extract_json_payload(response.text, dict)
+        if result is None:
+            raise ValueError("no JSON object in response")
         limiter.set_cache(cache_key, result)
         return result
     except Exception as e:
@@ -307,6 +444,57 @@ def predict_initial_symptoms(scenario_name: str, api_key: str) -> Dict:
 # =====================================================
 # 原因分析レポート生成
 # =====================================================
+@lru_cache(maxsize=64)
+def _analyst_report_request(scenario: str, node_id: str, vendor: str, os_type: str, verification_context: str):
+    """(プロンプト, キャッシュキー) を構築（引数はすべてハッシュ可能な値）"""
+    # プロンプト構成（具体的情報を復活）
+    prompt = f"""あなたは熟練のネットワークエンジニアです。
+以下の情報を元に、障害原因を特定し、技術的根拠を示してください。
+
+【対象機器】
+Hostname: {node_id} ({vendor} {os_type})
+
+【発生しているログ・アラーム (Fact)】
+{verification_context}
+
+【障害シナリオ】
+{scenario}
+
+【出力要件】
+以下の2項目のみを簡潔に出力すること（挨拶不要）。
+
+1. ■ 根本原因
+(ログに基づき、何が起きているか具体的に断定する)
+
+2. ■ 特定根拠
+(どのログメッセージ、どのアラームから判断したか。技術的な裏付けを箇条書きで)
+"""
+    return prompt, compute_cache_hash(scenario, node_id, compute_prompt_hash(prompt))
+
+
+def normalize_verification_context(verification_context: Optional[str]) -> str:
+    """レポート入力の検証ログを正規化（空・None は「特になし」）
+
+    個別生成・一括生成の双方がハッシュ化の前にこれを通すことで、同じ候補が同じキャッシュキーになる。
+    """
+    return verification_context or "特になし"
+
+
+def _analyst_report_prompt_and_key(scenario: str, target_node, verification_context: Optional[str]):
+    """原因分析レポート（ストリーミング版・一括版共通）の1件分のプロンプトと共有キャッシュキー
+
+    同じ入力での再試行・再クリック時にプロンプトの組み立てと正規化ハッシュを省くためメモ化する。
+    一括生成の結果も個別生成と同じキーで保存する。
+    """
+    return _analyst_report_request(
+        scenario,
+        target_node.id,
+        target_node.metadata.get("vendor", "Unknown"),
+        target_node.metadata.get("os", "Unknown OS"),
+        normalize_verification_context(verification_context),
+    )
+
+
 def generate_analyst_report(
     scenario: str, 
     target_node, 
@@ -381,37 +569,13 @@ def generate_analyst_report_streaming(
     
     limiter = _get_rate_limiter()
     
-    cache_key = compute_cache_hash(scenario, target_node.id, "analyst_streaming_final")
+    prompt, cache_key = _analyst_report_prompt_and_key(scenario, target_node, verification_context)
+
+    # キャッシュチェック（同一内容のプロンプトはセッションを跨いで再利用）
     cached = limiter.get_cache(cache_key)
     if cached:
         yield cached
         return
-    
-    vendor = target_node.metadata.get("vendor", "Unknown")
-    os_type = target_node.metadata.get("os", "Unknown OS")
-    
-    # プロンプト構成（具体的情報を復活）
-    prompt = f"""あなたは熟練のネットワークエンジニアです。
-以下の情報を元に、障害原因を特定し、技術的根拠を示してください。
-
-【対象機器】
-Hostname: {target_node.id} ({vendor} {os_type})
-
-【発生しているログ・アラーム (Fact)】
-{verification_context}
-
-【障害シナリオ】
-{scenario}
-
-【出力要件】
-以下の2項目のみを簡潔に出力すること（挨拶不要）。
-
-1. ■ 根本原因
-(ログに基づき、何が起きているか具体的に断定する)
-
-2. ■ 特定根拠
-(どのログメッセージ、どのアラームから判断したか。技術的な裏付けを箇条書きで)
-"""
 
     for attempt in range(max_retries + 1):
         try:
@@ -456,6 +620,89 @@ Hostname: {target_node.id} ({vendor} {os_type})
             return
 
 
+def _batch_report_prompt(items: List[Dict[str, Any]]) -> str:
+    """複数件の原因分析を1回で依頼するプロンプト（[index i] 区切りで各件の事実を並べる）"""
+    blocks = []
+    for i, item in enumerate(items):
+        node = item["target_node"]
+        vendor = node.metadata.get("vendor", "Unknown")
+        os_type = node.metadata.get("os", "Unknown OS")
+        blocks.append(f"""[index {i}]
+Hostname: {node.id} ({vendor} {os_type})
+シナリオ: {item["scenario"]}
+ログ・アラーム (Fact): {normalize_verification_context(item.get("verification_context"))}""")
+    facts = "\n\n".join(blocks)
+    return f"""あなたは熟練のネットワークエンジニアです。
+以下の各件について、障害原因を特定し、技術的根拠を示してください。
+
+{facts}
+
+【出力要件】
+次のJSONのみを出力すること（挨拶・コードフェンス不要）。results は全件分を index 順に含める。
+{{"results": [{{"index": 0, "root_cause": "ログに基づき何が起きているかを断定", "evidence": ["判断に用いたログ・アラームと技術的な裏付け"]}}]}}
+"""
+
+
+def _format_batch_report(entry: Dict[str, Any]) -> str:
+    """一括生成の1件分を個別生成と同じ2項目構成のテキストに整形"""
+    evidence = entry.get("evidence") or []
+    if isinstance(evidence, str):
+        evidence = [evidence]
+    lines = "\n".join(f"- {e}" for e in evidence)
+    return f"1. ■ 根本原因\n{entry.get('root_cause', '')}\n\n2. ■ 特定根拠\n{lines}"
+
+
+def generate_analyst_reports_batch(items: List[Dict[str, Any]], api_key: str) -> Dict[int, str]:
+    """複数件の原因分析レポートを REPORT_BATCH_SIZE 件ずつまとめて生成（キャッシュ事前投入用）
+
+    items の各要素は scenario / target_node / verification_context を持つ dict。
+    結果は items のインデックスをキーにした dict で、生成できた件だけを含む。
+    生成結果は個別生成（generate_analyst_report_streaming）と同じキャッシュキーで保存する。
+    """
+    if not api_key or not items:
+        return {}
+    model = _ensure_api_configured(api_key)
+    if not model:
+        return {}
+
+    limiter = _get_rate_limiter()
+    reports: Dict[int, str] = {}
+    pending = []
+    for i, item in enumerate(items):
+        _, cache_key = _analyst_report_prompt_and_key(
+            item["scenario"], item["target_node"], item.get("verification_context")
+        )
+        cached = limiter.get_cache(cache_key)
+        if cached:
+            reports[i] = cached
+        else:
+            pending.append((i, cache_key))
+
+    # バッチ同士は独立しているため並列に投げる
+    chunks = [pending[start:start + REPORT_BATCH_SIZE] for start in range(0, len(pending), REPORT_BATCH_SIZE)]
+    responses = call_llm_many(model, [_batch_report_prompt([items[i] for i, _ in chunk]) for chunk in chunks])
+
+    for chunk, response in zip(chunks, responses):
+        try:
+            if isinstance(response, Exception):
+                raise response
+            payload = extract_json_payload(response.text, dict) or {}
+        except Exception as e:
+            logger.error(f"generate_analyst_reports_batch error: {e}")
+            continue
+        for entry in payload.get("results") or []:
+            try:
+                idx = int(entry.get("index", -1))
+            except (TypeError, ValueError, AttributeError):
+                continue
+            if 0 <= idx < len(chunk):
+                item_index, cache_key = chunk[idx]
+                report = filter_hallucination(_format_batch_report(entry))
+                limiter.set_cache(cache_key, report)
+                reports[item_index] = report
+    return reports
+
+
 # =====================================================
 # 復旧コマンド生成
 # =====================================================
@@ -525,28 +772,10 @@ def generate_remediation_commands_streaming(
     
     limiter = _get_rate_limiter()
     
-    cache_key = compute_cache_hash(scenario, target_node.id, "remediation_streaming_final")
-    cached = limiter.get_cache(cache_key)
-    if cached:
-        yield cached
-        return
-    
     # 1. Configファイルの読み込み
-    current_config_content = ""
-    try:
-        # 複数のパス候補を探す
-        paths = [f"configs/{target_node.id}.txt", f"{target_node.id}.txt"]
-        for p in paths:
-            if os.path.exists(p):
-                with open(p, "r", encoding="utf-8") as f:
-                    current_config_content = f.read()
-                break
-    except Exception:
-        pass
-
     # 2. 【セキュリティ対策】読み込んだConfigをサニタイズ（パスワード除去）
-    if current_config_content:
-        current_config_content = sanitize_output(current_config_content)
+    # （サニタイズ・切り詰め済みの抜粋をファイル更新時刻ごとにキャッシュ）
+    current_config_content = sanitized_config_excerpt(target_node.id)
     
     # プロンプト構成
     prompt = f"""あなたは熟練のネットワークエンジニアです。
@@ -557,7 +786,7 @@ def generate_remediation_commands_streaming(
 {target_node.id}
 
 【現在の設定 (Current Config / Sanitized)】
-{current_config_content[:3000] if current_config_content else "Config取得不可。一般的な手順を作成せよ。"}
+{current_config_content or "Config取得不可。一般的な手順を作成せよ。"}
 
 【障害シナリオ】
 {scenario}
@@ -575,6 +804,13 @@ def generate_remediation_commands_streaming(
 (Pingの宛先はConfig内の対向IPなどを使用すること)
 """
 
+    # キャッシュチェック（同一内容のプロンプトはセッションを跨いで再利用）
+    cache_key = compute_cache_hash(scenario, target_node.id, compute_prompt_hash(prompt))
+    cached = limiter.get_cache(cache_key)
+    if cached:
+        yield cached
+        return
+
     for attempt in range(max_retries + 1):
         try:
             response_iterator = _call_llm_with_rate_limit(model, prompt, stream=True)
@@ -620,6 +856,22 @@ def generate_remediation_commands_streaming(
 # =====================================================
 # 診断シミュレーション
 # =====================================================
+@lru_cache(maxsize=64)
+def _diagnostic_mode(scenario_type: str) -> str:
+    """シナリオ名から診断方法を判定（シナリオ名ごとに一度だけ文字列照合する）
+
+    Returns:
+        "skip"（対応不要） / "live"（実機接続） / "unreachable"（接続不可） / "generated"（AI生成ログ）
+    """
+    if "---" in scenario_type or "正常" in scenario_type:
+        return "skip"
+    if "[Live]" in scenario_type:
+        return "live"
+    if "全回線断" in scenario_type or "サイレント" in scenario_type or "両系" in scenario_type:
+        return "unreachable"
+    return "generated"
+
+
 def run_diagnostic_simulation(
     scenario_type: str,
     target_node=None,
@@ -627,12 +879,16 @@ def run_diagnostic_simulation(
 ) -> Dict:
     time.sleep(1.5)
     
-    if "---" in scenario_type or "正常" in scenario_type:
+    mode = _diagnostic_mode(scenario_type)
+    if mode == "skip":
         return {"status": "SKIPPED", "sanitized_log": "No action required.", "error": None}
     
-    if "[Live]" in scenario_type:
+    if mode == "live":
         commands = ["terminal length 0", "show version", "show interface brief", "show ip route"]
         try:
+            # netmiko (paramiko) は実機診断時のみ読み込む
+            from netmiko import ConnectHandler
+
             with ConnectHandler(**SANDBOX_DEVICE) as ssh:
                 if not ssh.check_enable_mode():
                     ssh.enable()
@@ -645,7 +901,7 @@ def run_diagnostic_simulation(
             return {"status": "ERROR", "sanitized_log": "", "error": str(e)}
         return {"status": "SUCCESS", "sanitized_log": sanitize_output(raw_output), "error": None}
     
-    elif "全回線断" in scenario_type or "サイレント" in scenario_type or "両系" in scenario_type:
+    elif mode == "unreachable":
         return {"status": "ERROR", "sanitized_log": "", "error": "Connection timed out"}
     
     else:
@@ -12,15 +12,22 @@ gemma-3-12b-it の制限:
 """
 
 import time
+import random
 import threading
 import logging
-from typing import Optional, Dict, Any, Callable
-from collections import deque
+from typing import Optional, Dict, Any, Callable, Union, Iterable, Iterator
+from collections import OrderedDict, deque
 from dataclasses import dataclass, field
 from functools import wraps
+from contextlib import contextmanager
 import hashlib
 import json
 
+try:
+    import orjson  # 任意依存（導入されていれば JSON の直列化・解析に使う）
+except ImportError:
+    orjson = None
+
 logger = logging.getLogger(__name__)
 
 # =====================================================
@@ -37,6 +44,75 @@ class RateLimitConfig:
     retry_base_delay: float = 2.0    # リトライ基本待機時間
     retry_max_delay: float = 60.0    # リトライ最大待機時間
     cache_ttl: int = 3600            # キャッシュTTL (秒)
+    max_concurrent: int = 4          # 同時に実行中にできるリクエスト数
+
+
+# =====================================================
+# 有界 LRU キャッシュ
+# =====================================================
+class LRUCache(OrderedDict):
+    """
+    件数上限付きの LRU キャッシュ (dict 互換)
+    
+    参照・更新されたキーを末尾へ移動し、上限を超えたら最も古いキーから破棄する。
+    セッション状態に置くキャッシュが操作のたびに際限なく肥大化するのを防ぐ。
+    """
+    
+    def __init__(self, maxsize: int = 128, *args, **kwargs):
+        self.maxsize = maxsize
+        super().__init__(*args, **kwargs)
+    
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self.move_to_end(key)
+        return value
+    
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+    
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        while len(self) > self.maxsize:
+            self.popitem(last=False)
+
+
+# =====================================================
+# ストリーミング応答用の枠保持イテレータ
+# =====================================================
+class SlotHoldingIterator:
+    """
+    ストリーミング応答を読み切るまで同時実行数の枠を保持するイテレータ
+    
+    最後まで読んだとき・読み出し中に例外が出たとき・close() されたとき・
+    途中で破棄されたときのいずれかで、枠を一度だけ返却する。
+    """
+    
+    def __init__(self, stream: Iterable, release: Callable[[], None]):
+        self._iterator = iter(stream)
+        self._release = release
+        self._released = False
+    
+    def __iter__(self) -> "SlotHoldingIterator":
+        return self
+    
+    def __next__(self):
+        try:
+            return next(self._iterator)
+        except BaseException:
+            self.close()
+            raise
+    
+    def close(self):
+        """枠を返却（複数回呼んでも返却は一度だけ）"""
+        if not self._released:
+            self._released = True
+            self._release()
+    
+    def __del__(self):
+        self.close()
 
 
 # =====================================================
@@ -73,6 +149,7 @@ class GlobalRateLimiter:
         self._cache: Dict[str, Dict[str, Any]] = {}
         self._cache_lock = threading.Lock()
         self._request_lock = threading.Lock()
+        self._concurrency = threading.BoundedSemaphore(max(1, self.config.max_concurrent))
         self._initialized = True
         
         logger.info(f"GlobalRateLimiter initialized: {self.config.rpm} RPM, {self.config.rpd} RPD")
@@ -109,7 +186,7 @@ class GlobalRateLimiter:
     
     def compute_cache_key(self, *args, **kwargs) -> str:
         """キャッシュキーを計算"""
-        content = json.dumps({'args': args, 'kwargs': kwargs}, sort_keys=True, default=str)
+        content = dumps_sorted({'args': args, 'kwargs': kwargs})
         return hashlib.md5(content.encode()).hexdigest()
     
     def _check_daily_limit(self) -> bool:
@@ -134,18 +211,15 @@ class GlobalRateLimiter:
         effective_limit = int(self.config.rpm * self.config.safety_margin)
         return len(self._request_times) < effective_limit
     
-    def wait_for_slot(self, timeout: float = 120.0) -> bool:
-        """
-        リクエスト可能になるまで待機
-        
-        Returns:
-            bool: リクエスト可能ならTrue
-        """
+    def _wait(self, timeout: float, reserve: bool) -> bool:
+        """枠が空くまで待機（reserve=True なら同一ロック内で枠を確保）"""
         start_time = time.time()
         
         while time.time() - start_time < timeout:
             with self._request_lock:
                 if self._check_daily_limit() and self._check_minute_limit():
+                    if reserve:
+                        self._record_locked()
                     return True
             
             # 待機時間を計算
@@ -163,12 +237,72 @@ class GlobalRateLimiter:
         logger.warning("Rate limit: timeout waiting for slot")
         return False
     
+    def wait_for_slot(self, timeout: float = 120.0) -> bool:
+        """
+        リクエスト可能になるまで待機（枠は確保しない）
+        
+        Returns:
+            bool: リクエスト可能ならTrue
+        """
+        return self._wait(timeout, reserve=False)
+    
+    def acquire(self, timeout: float = 120.0) -> bool:
+        """
+        リクエスト枠を確保（空き確認と記録を1回のロック内で行う）
+        
+        wait_for_slot() + record_request() の組み合わせと異なり、
+        確認から記録までの間に他スレッドが枠を奪う競合が起きない。
+        
+        Returns:
+            bool: 枠を確保できたらTrue
+        """
+        return self._wait(timeout, reserve=True)
+    
+    @contextmanager
+    def concurrency_slot(self, timeout: float = 120.0):
+        """
+        同時実行数の枠を確保するコンテキストマネージャ
+        
+        RPM/RPD の枠とは別に、実行中のリクエスト数を max_concurrent 以下に抑える。
+        チャット・レポート・推論が同時に走っても、先行リクエストの応答待ちで
+        後続が際限なく積み上がらないようにする。
+        """
+        if not self._concurrency.acquire(timeout=timeout):
+            raise RuntimeError("Concurrency limit: timeout waiting for slot")
+        try:
+            yield
+        finally:
+            self._concurrency.release()
+    
+    def stream_in_slot(self, open_stream: Callable[[], Iterable], timeout: float = 120.0) -> Iterator:
+        """
+        同時実行数の枠内でストリーミング呼び出しを開始し、応答を読み切るまで枠を保持する
+        
+        concurrency_slot() で囲むだけでは stream=True の呼び出しが戻った時点
+        （chunk を読む前）に枠が返却され、長時間かかる応答本体が上限に数えられない。
+        
+        Args:
+            open_stream: ストリーミング応答（イテラブル）を返す呼び出し
+        """
+        if not self._concurrency.acquire(timeout=timeout):
+            raise RuntimeError("Concurrency limit: timeout waiting for slot")
+        try:
+            stream = open_stream()
+        except BaseException:
+            self._concurrency.release()
+            raise
+        return SlotHoldingIterator(stream, self._concurrency.release)
+    
+    def _record_locked(self):
+        """リクエストを記録（_request_lock 取得済みであること）"""
+        self._request_times.append(time.time())
+        self._daily_count += 1
+        logger.debug(f"Request recorded: {len(self._request_times)}/{self.config.rpm} RPM, {self._daily_count}/{self.config.rpd} RPD")
+    
     def record_request(self):
         """リクエストを記録"""
         with self._request_lock:
-            self._request_times.append(time.time())
-            self._daily_count += 1
-            logger.debug(f"Request recorded: {len(self._request_times)}/{self.config.rpm} RPM, {self._daily_count}/{self.config.rpd} RPD")
+            self._record_locked()
     
     def get_stats(self) -> Dict[str, Any]:
         """現在の統計を取得"""
@@ -215,11 +349,10 @@ def rate_limited(use_cache: bool = True, cache_key_func: Optional[Callable] = No
                     return cached
             
             # レート制限待機
-            if not limiter.wait_for_slot():
+            if not limiter.acquire():
                 raise RuntimeError("Rate limit exceeded: timeout waiting for available slot")
             
             # リクエスト実行
-            limiter.record_request()
             result = func(*args, **kwargs)
             
             # キャッシュ保存
@@ -262,11 +395,10 @@ def rate_limited_with_retry(
             for attempt in range(max_retries + 1):
                 try:
                     # レート制限待機
-                    if not limiter.wait_for_slot():
+                    if not limiter.acquire():
                         raise RuntimeError("Rate limit exceeded")
                     
                     # リクエスト実行
-                    limiter.record_request()
                     result = func(*args, **kwargs)
                     
                     # キャッシュ保存
@@ -285,9 +417,10 @@ def rate_limited_with_retry(
                     should_retry = should_retry or 'rate' in error_msg
                     
                     if should_retry and attempt < max_retries:
-                        delay = min(
-                            config.retry_base_delay * (2 ** attempt),
-                            config.retry_max_delay
+                        delay = compute_backoff_delay(
+                            attempt,
+                            base_delay=config.retry_base_delay,
+                            max_delay=config.retry_max_delay
                         )
                         logger.warning(f"Retry {attempt + 1}/{max_retries}: waiting {delay:.1f}s after error: {e}")
                         time.sleep(delay)
@@ -308,6 +441,48 @@ def get_rate_limiter() -> GlobalRateLimiter:
     return GlobalRateLimiter()
 
 
+def compute_backoff_delay(
+    attempt: int,
+    base_delay: float = 2.0,
+    max_delay: float = 60.0,
+    jitter: float = 1.0
+) -> float:
+    """
+    ジッター付き指数バックオフの待機時間を計算
+    
+    複数セッションのリトライが同時刻に集中しないよう、
+    base_delay * 2^attempt に 0〜jitter 秒の乱数を加える。
+    
+    Args:
+        attempt: 試行回数 (0始まり)
+        base_delay: 基本待機時間
+        max_delay: 待機時間の上限
+        jitter: 加算する乱数の最大値
+    """
+    return min(base_delay * (2 ** attempt) + random.uniform(0, jitter), max_delay)
+
+
+def dumps_sorted(obj: Any) -> str:
+    """キー順を固定した JSON 文字列（キャッシュキー用。orjson があれば使う）
+
+    orjson の有無で出力の書式は異なるが、同一プロセス内では常に同じ結果になる。
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, default=str, option=orjson.OPT_SORT_KEYS).decode("utf-8")
+        except TypeError:
+            # 文字列以外のキーなど orjson が扱えない値は標準 json に任せる
+            pass
+    return json.dumps(obj, ensure_ascii=False, sort_keys=True, separators=(",", ":"), default=str)
+
+
+def loads_json(text: Union[str, bytes]) -> Any:
+    """JSON 文字列（UTF-8 のバイト列も可）を解析（orjson があれば使う）。不正な入力は ValueError"""
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+
 def estimate_tokens(text: str) -> int:
     """
     トークン数を概算（日本語対応）
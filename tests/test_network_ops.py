@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+network_ops のテスト（python -m unittest discover -s tests で実行）
+
+google.generativeai は sys.modules 上のスタブに差し替え、SDK なしで動かす。
+"""
+
+import json
+import sys
+import types
+import unittest
+from unittest import mock
+
+import network_ops
+
+
+def _fake_genai():
+    """configure されたキーを記録する google.generativeai のスタブ"""
+    genai = types.ModuleType("google.generativeai")
+    genai.configured_keys = []
+
+    def configure(api_key=None):
+        genai.configured_keys.append(api_key)
+
+    class GenerativeModel:
+        def __init__(self, model_name, generation_config=None):
+            self.model_name = model_name
+            self.generation_config = generation_config
+
+    genai.configure = configure
+    genai.GenerativeModel = GenerativeModel
+    return genai
+
+
+class GenerativeModelFactoryTest(unittest.TestCase):
+    def setUp(self):
+        self.genai = _fake_genai()
+        google = sys.modules.get("google") or types.ModuleType("google")
+        patcher = mock.patch.dict(sys.modules, {"google": google, "google.generativeai": self.genai})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        network_ops._cached_generative_model.cache_clear()
+        self.addCleanup(network_ops._cached_generative_model.cache_clear)
+
+    def test_switching_keys_back_reconfigures_the_first_key(self):
+        model_a = network_ops.get_generative_model("key-a", "m", 0.0)
+        network_ops.get_generative_model("key-b", "m", 0.0)
+        model_a_again = network_ops.get_generative_model("key-a", "m", 0.0)
+
+        self.assertIs(model_a_again, model_a)
+        self.assertEqual(self.genai.configured_keys[-1], "key-a")
+
+    def test_analysis_model_reactivates_its_key_after_chat_switch(self):
+        with mock.patch.object(network_ops, "_model_api_key", None):
+            model_a = network_ops._ensure_api_configured("key-a")
+            # チャットなど別経路で別キーのモデルを取得
+            network_ops.get_generative_model("key-b")
+            self.assertEqual(self.genai.configured_keys[-1], "key-b")
+
+            self.assertIs(network_ops._ensure_api_configured("key-a"), model_a)
+            self.assertEqual(self.genai.configured_keys[-1], "key-a")
+
+            # キー未指定時は直近のキーを再度有効にする
+            network_ops.get_generative_model("key-b")
+            self.assertIs(network_ops._ensure_api_configured(""), model_a)
+            self.assertEqual(self.genai.configured_keys[-1], "key-a")
+
+
+class AnalystReportWarmCacheTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(network_ops, "_ensure_api_configured", return_value=object())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.node = types.SimpleNamespace(id="WAN_ROUTER_01", metadata={"vendor": "Cisco", "os": "IOS-XE"})
+
+    def test_warmed_report_is_a_cache_hit_without_verification_log(self):
+        scenario = "test: warmed report cache hit"
+        batch_response = types.SimpleNamespace(text=json.dumps(
+            {"results": [{"index": 0, "root_cause": "電源故障", "evidence": ["PSU アラーム"]}]}
+        ))
+        with mock.patch.object(network_ops, "call_llm_many", return_value=[batch_response]):
+            reports = network_ops.generate_analyst_reports_batch(
+                [{"scenario": scenario, "target_node": self.node, "verification_context": None}], "key"
+            )
+        self.assertIn(0, reports)
+
+        # 個別生成は空の検証ログでも一括生成と同じキーを引き、LLM を呼ばない
+        with mock.patch.object(network_ops, "_call_llm_with_rate_limit") as call_llm:
+            chunks = list(network_ops.generate_analyst_report_streaming(
+                scenario, self.node, "", "", "", "key"
+            ))
+        call_llm.assert_not_called()
+        self.assertEqual(chunks, [reports[0]])
+
+
+if __name__ == "__main__":
+    unittest.main()